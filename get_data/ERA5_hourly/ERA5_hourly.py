@@ -1,9 +1,16 @@
 # Functions to load ERA5 Hourly data
 
 import os
+import json
+import datetime
+import collections
 import iris
+import iris.cube
+import iris.util
 from iris.util import squeeze
+import iris.coords
 import iris.coord_systems
+import cf_units
 import numpy as np
 
 # Don't really understand this, but it gets rid of the error messages.
@@ -33,6 +40,267 @@ def get_land_mask():
     return land_mask
 
 
+# Index of the hours in a monthly file: the time index for each (day, hour)
+#  (-1 if missing), and the layout of the expver dimension (its position
+#  and the index of expver 1, or -1 if there isn't one). Made from the
+#  cube's time coordinate once, and kept alongside the data (on scratch),
+#  so finding an hour is an array lookup rather than a constraint check
+#  on every time point.
+def make_time_index(cube):
+    times = np.full((32, 24), -1, dtype=np.int32)
+    for index, cell in enumerate(cube.coord("time").cells()):
+        times[cell.point.day, cell.point.hour] = index
+    expver = np.array([-1, -1], dtype=np.int32)
+    if len(cube.coords("expver")) > 0 and len(cube.coord_dims("expver")) > 0:
+        expver[0] = cube.coord_dims("expver")[0]
+        expver[1] = np.where(cube.coord("expver").points == 1)[0][0]
+    return times, expver
+
+
+def get_time_index(cube, fname, year, month, variable):
+    index_file = "%s/AnimH/ERA5_index/%04d/%02d/%s.npz" % (
+        os.getenv("SCRATCH"),
+        year,
+        month,
+        variable,
+    )
+    # Remake the index if the data file has changed since it was made
+    stamp = np.array([os.path.getmtime(fname), os.path.getsize(fname)])
+    if os.path.isfile(index_file):
+        with np.load(index_file) as cached:
+            if np.array_equal(cached["stamp"], stamp):
+                return cached["times"], cached["expver"]
+    times, expver = make_time_index(cube)
+    os.makedirs(os.path.dirname(index_file), exist_ok=True)
+    # Write to a temporary file, and rename when complete, so a job opening
+    #  the same month never loads a partial index.
+    np.savez("%s.tmp.npz" % index_file, times=times, expver=expver, stamp=stamp)
+    os.replace("%s.tmp.npz" % index_file, index_file)
+    return times, expver
+
+
+# Monthly files already opened: (lazy) cube and index of hours (or, for the
+#  binary store, mapped data, header and coordinates), by file name.
+#  Only the most recently used few are kept.
+open_files = collections.OrderedDict()
+
+
+def open_month(variable, year, month):
+    fname = "%s/ERA5/hourly/reanalysis/%04d/%02d/%s.nc" % (
+        os.getenv("SCRATCH"),
+        year,
+        month,
+        variable,
+    )
+    if fname not in open_files:
+        if not os.path.isfile(fname):
+            raise Exception("No data file %s" % fname)
+        cube = iris.load_cube(fname)
+        open_files[fname] = (cube,) + get_time_index(cube, fname, year, month, variable)
+        while len(open_files) > 12:
+            open_files.popitem(last=False)
+    open_files.move_to_end(fname)
+    return open_files[fname]
+
+
+# Binary store - an alternative to the NetCDF files. Each monthly file is
+#  rewritten (by make_binary_store.py) as an uncompressed (time, lat, lon)
+#  array in an .npy file, so each hour is a contiguous slab that can be
+#  memory-mapped, with a JSON header (metadata and time index) and an .npz
+#  of the coordinates alongside. The array has the dtype the NetCDF data
+#  are read as (float64 for packed data), so a month gives the same values
+#  from either.
+def binary_store_name(variable, year, month):
+    return "%s/ERA5/hourly/binary/%04d/%02d/%s" % (
+        os.getenv("SCRATCH"),
+        year,
+        month,
+        variable,
+    )
+
+
+# Attribute values as something JSON can store
+def json_value(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def coord_header(coord):
+    return {
+        "standard_name": coord.standard_name,
+        "long_name": coord.long_name,
+        "var_name": coord.var_name,
+        "units": str(coord.units),
+        "calendar": coord.units.calendar,
+        "circular": getattr(coord, "circular", False),
+    }
+
+
+def make_coord(header, points):
+    return iris.coords.DimCoord(
+        points,
+        standard_name=header["standard_name"],
+        long_name=header["long_name"],
+        var_name=header["var_name"],
+        units=cf_units.Unit(header["units"], calendar=header["calendar"]),
+        circular=header["circular"],
+    )
+
+
+# Convert one monthly NetCDF file into the binary store. Copied in blocks
+#  of a day, so the whole month is never in memory at once.
+def write_binary_store(variable, year, month):
+    fname = "%s/ERA5/hourly/reanalysis/%04d/%02d/%s.nc" % (
+        os.getenv("SCRATCH"),
+        year,
+        month,
+        variable,
+    )
+    if not os.path.isfile(fname):
+        raise Exception("No data file %s" % fname)
+    cube = iris.load_cube(fname)
+    # Get rid of unnecessary height dimensions
+    if len(cube.shape) == 4:
+        cube = cube.extract(iris.Constraint(expver=1))
+    if cube.coord_dims("time") != (0,) or cube.ndim != 3:
+        raise Exception("Expected (time, lat, lon) data in %s" % fname)
+    times, expver = make_time_index(cube)
+    base = binary_store_name(variable, year, month)
+    os.makedirs(os.path.dirname(base), exist_ok=True)
+    # Stored as floats (so masked points can be NaN), and converted back to
+    #  the source dtype on loading
+    dtype = np.result_type(cube.dtype, np.float32)
+    # Write to temporary files, and rename when complete, so readers
+    #  never see a partial store.
+    data = np.lib.format.open_memmap(
+        "%s.tmp.npy" % base, mode="w+", dtype=dtype, shape=cube.shape
+    )
+    masked = False
+    for start in range(0, cube.shape[0], 24):
+        block = cube[start : start + 24].data
+        if np.ma.is_masked(block):
+            masked = True
+            block = block.astype(dtype).filled(np.nan)
+        data[start : start + 24] = block
+    data.flush()
+    del data
+    np.savez(
+        "%s.tmp.npz" % base,
+        latitude=cube.coord("latitude").points,
+        longitude=cube.coord("longitude").points,
+        time=cube.coord("time").points,
+        times=times,
+    )
+    header = {
+        "standard_name": cube.standard_name,
+        "long_name": cube.long_name,
+        "var_name": cube.var_name,
+        "units": str(cube.units),
+        "attributes": {k: json_value(v) for k, v in cube.attributes.items()},
+        "dtype": str(cube.dtype),
+        "masked": masked,
+        "coords": {
+            name: coord_header(cube.coord(name))
+            for name in ("latitude", "longitude", "time")
+        },
+        "stamp": [os.path.getmtime(fname), os.path.getsize(fname)],
+    }
+    with open("%s.tmp.json" % base, "w") as f:
+        json.dump(header, f, indent=1)
+    os.replace("%s.tmp.npy" % base, "%s.npy" % base)
+    os.replace("%s.tmp.npz" % base, "%s.npz" % base)
+    os.replace("%s.tmp.json" % base, "%s.json" % base)
+
+
+# Is there an up-to-date binary store for this month? (Up-to-date if the
+#  NetCDF file has not changed since it was converted, or is gone; a store
+#  with no source dtype is from an older version, always float32, and is
+#  out-of-date).
+def have_binary_store(variable, year, month):
+    base = binary_store_name(variable, year, month)
+    if not os.path.isfile("%s.json" % base):
+        return False
+    with open("%s.json" % base) as f:
+        header = json.load(f)
+    if "dtype" not in header:
+        return False
+    fname = "%s/ERA5/hourly/reanalysis/%04d/%02d/%s.nc" % (
+        os.getenv("SCRATCH"),
+        year,
+        month,
+        variable,
+    )
+    if not os.path.isfile(fname):
+        return True
+    return header["stamp"] == [os.path.getmtime(fname), os.path.getsize(fname)]
+
+
+# Open a month of the binary store: the data are memory-mapped (read-only),
+#  and so shared, through the page cache, between processes.
+def open_binary_month(variable, year, month):
+    base = binary_store_name(variable, year, month)
+    if base not in open_files:
+        if not os.path.isfile("%s.json" % base):
+            raise Exception("No binary store %s" % base)
+        with open("%s.json" % base) as f:
+            header = json.load(f)
+        with np.load("%s.npz" % base) as f:
+            coords = {name: f[name] for name in f.files}
+        data = np.load("%s.npy" % base, mmap_mode="r")
+        open_files[base] = (data, header, coords)
+        while len(open_files) > 12:
+            open_files.popitem(last=False)
+    open_files.move_to_end(base)
+    return open_files[base]
+
+
+# Cube of the time point(s) at index in a month of the binary store - index
+#  is one time index (giving a (lat, lon) cube) or a slice or array of them
+#  (giving a (time, lat, lon) cube).
+def binary_cube(variable, year, month, index):
+    data, header, coords = open_binary_month(variable, year, month)
+    # Copied out of the mapping, so the cube's data can be changed; and a
+    #  masked array of the source dtype, as from the NetCDF files
+    field = np.ma.MaskedArray(np.array(data[index]))
+    if header["masked"]:
+        field = np.ma.masked_invalid(field)
+    field = field.astype(header.get("dtype", "float32"), copy=False)
+    first = field.ndim - 2  # Latitude dimension
+    varC = iris.cube.Cube(
+        field,
+        standard_name=header["standard_name"],
+        long_name=header["long_name"],
+        var_name=header["var_name"],
+        units=header["units"],
+        attributes=header["attributes"],
+        dim_coords_and_dims=[
+            (make_coord(header["coords"]["latitude"], coords["latitude"]), first),
+            (
+                make_coord(header["coords"]["longitude"], coords["longitude"]),
+                first + 1,
+            ),
+        ],
+    )
+    time = make_coord(header["coords"]["time"], coords["time"][index])
+    if first > 0:
+        varC.add_dim_coord(time, 0)
+    else:
+        varC.add_aux_coord(time)
+    return varC
+
+
+def load_binary(variable, year, month, day, hour):
+    times = open_binary_month(variable, year, month)[2]["times"]
+    if times[day, hour] < 0:
+        raise Exception(
+            "No %s data for %04d-%02d-%02d:%02d" % (variable, year, month, day, hour)
+        )
+    return binary_cube(variable, year, month, times[day, hour])
+
+
 def load(
     variable="total_precipitation",
     year=None,
@@ -41,24 +309,124 @@ def load(
     hour=None,
     constraint=None,
     grid=None,
+    backend="auto",
 ):
     if year is None or month is None or day is None or hour is None:
         raise Exception("Year, month, day, and hour must be specified")
-    fname = "%s/ERA5/hourly/reanalysis/%04d/%02d/%s.nc" % (
-        os.getenv("SCRATCH"),
-        year,
-        month,
-        variable,
-    )
-    if not os.path.isfile(fname):
-        raise Exception("No data file %s" % fname)
-    ftt = iris.Constraint(
-        time=lambda cell: cell.point.day == day and cell.point.hour == hour
-    )
-    varC = iris.load_cube(fname, ftt)
-    # Get rid of unnecessary height dimensions
-    if len(varC.data.shape) == 3:
-        varC = varC.extract(iris.Constraint(expver=1))
+    # Use the binary store ("binary"), the NetCDF files ("netcdf"),
+    #  or the binary store if this month has been converted ("auto").
+    if backend == "auto":
+        backend = "netcdf"
+        if have_binary_store(variable, year, month):
+            backend = "binary"
+    if backend == "binary":
+        varC = load_binary(variable, year, month, day, hour)
+    elif backend == "netcdf":
+        varC = load_netcdf(variable, year, month, day, hour)
+    else:
+        raise Exception("Unknown backend %s" % backend)
+    add_coord_system(varC)
+    varC.long_name = variable
+    if grid is not None:
+        varC = varC.regrid(grid, iris.analysis.Nearest())
+    if constraint is not None:
+        varC = varC.extract(constraint)
+    return varC
+
+
+def load_netcdf(variable, year, month, day, hour):
+    cube, times, expver = open_month(variable, year, month)
+    if times[day, hour] < 0:
+        raise Exception(
+            "No %s data for %04d-%02d-%02d:%02d" % (variable, year, month, day, hour)
+        )
+    # Read just the one hour (and expver 1, if there is an expver dimension)
+    index = [slice(None)] * cube.ndim
+    index[cube.coord_dims("time")[0]] = times[day, hour]
+    if expver[0] >= 0:
+        index[expver[0]] = expver[1]
+    varC = cube[tuple(index)]
+    varC.data
+    return varC
+
+
+# Load all the hours from start to end (inclusive) as one (time,lat,lon) cube.
+#  Every hour must be there - a missing hour is an error, as for load.
+#  Each month is opened once (and kept open, as for load), and its hours
+#  are found with the index of hours and read as one block - memory-mapped
+#  from the binary store, if the month has been converted (backend as
+#  for load).
+def load_range(
+    variable="total_precipitation",
+    start=None,
+    end=None,
+    constraint=None,
+    grid=None,
+    backend="auto",
+):
+    if start is None or end is None:
+        raise Exception("Start and end times must be specified")
+    if end < start:
+        raise Exception("End time %s is before start time %s" % (end, start))
+    months = iris.cube.CubeList()
+    current = datetime.datetime(start.year, start.month, 1)
+    while current <= end:
+        if current.month == 12:
+            next_month = datetime.datetime(current.year + 1, 1, 1)
+        else:
+            next_month = datetime.datetime(current.year, current.month + 1, 1)
+        month_backend = backend
+        if month_backend == "auto":
+            month_backend = "netcdf"
+            if have_binary_store(variable, current.year, current.month):
+                month_backend = "binary"
+        if month_backend == "binary":
+            times = open_binary_month(variable, current.year, current.month)[2]["times"]
+        elif month_backend == "netcdf":
+            cube, times, expver = open_month(variable, current.year, current.month)
+        else:
+            raise Exception("Unknown backend %s" % backend)
+        # Time indices of the hours in this month
+        hour = max(start, current)
+        if hour.minute != 0 or hour.second != 0 or hour.microsecond != 0:
+            hour = hour.replace(minute=0, second=0, microsecond=0)
+            hour += datetime.timedelta(hours=1)
+        last = min(end, next_month - datetime.timedelta(hours=1))
+        t_idx = []
+        while hour <= last:
+            if times[hour.day, hour.hour] < 0:
+                raise Exception(
+                    "No %s data for %04d-%02d-%02d:%02d"
+                    % (variable, hour.year, hour.month, hour.day, hour.hour)
+                )
+            t_idx.append(times[hour.day, hour.hour])
+            hour += datetime.timedelta(hours=1)
+        t_idx = np.array(t_idx, dtype=np.intp)
+        if len(t_idx) > 0:
+            # A slice, if the hours are consecutive, so it's one block read
+            if np.array_equal(t_idx, np.arange(t_idx[0], t_idx[-1] + 1)):
+                t_idx = slice(t_idx[0], t_idx[-1] + 1)
+            if month_backend == "binary":
+                varC = binary_cube(variable, current.year, current.month, t_idx)
+            else:
+                index = [slice(None)] * cube.ndim
+                index[cube.coord_dims("time")[0]] = t_idx
+                if expver[0] >= 0:
+                    index[expver[0]] = expver[1]
+                varC = cube[tuple(index)]
+                varC.data  # Read the block in one go
+            months.append(varC)
+        current = next_month
+    if len(months) == 0:
+        raise Exception("No %s data between %s and %s" % (variable, start, end))
+    # Months with different dtypes (from different sources) can't be
+    #  concatenated as they are
+    dtype = np.result_type(*[block.dtype for block in months])
+    for block in months:
+        if block.dtype != dtype:
+            block.data = block.data.astype(dtype)
+    iris.util.equalise_attributes(months)
+    varC = months.concatenate_cube()
     add_coord_system(varC)
     varC.long_name = variable
     if grid is not None:
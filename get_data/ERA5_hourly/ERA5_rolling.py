@@ -0,0 +1,114 @@
+# Rolling statistics over a window of ERA5 hourly fields
+
+# The window is kept in a ring buffer, with a running sum, so moving it
+#  on by an hour only needs one new field loading: add the new field
+#  and drop the oldest one.
+
+import datetime
+import numpy as np
+
+from get_data.ERA5_hourly.ERA5_hourly import load_range
+
+
+class RollingWindow:
+    def __init__(self, variable="2m_temperature", hours=5 * 24):
+        if hours % 2 != 0:
+            raise Exception("Window length must be an even number of hours")
+        self.variable = variable
+        self.hours = hours
+        self.start = None  # Time of the oldest field in the window
+        self.head = 0  # Index of the oldest field in the buffer
+        self.buffer = None  # (hours, lat, lon) - the fields in the window
+        self.total = None  # Running sum of the fields in the buffer
+        self.steps = 0  # Number of updates since total was last recalculated
+        self.template = None  # Cube with the grid and metadata of one field
+        self.composite = None  # Work array for the diurnal composite
+
+    # (Re)load the whole window, starting at start
+    def _fill(self, start):
+        fields = load_range(
+            self.variable, start, start + datetime.timedelta(hours=self.hours - 1)
+        )
+        if fields.shape[0] != self.hours:
+            raise Exception(
+                "Only %d hours of %s data from %s"
+                % (fields.shape[0], self.variable, start)
+            )
+        self.template = fields[0]
+        self.buffer = np.array(fields.data)
+        self.total = self.buffer.sum(axis=0, dtype=np.float64)
+        self.composite = np.zeros(self.total.shape, dtype=np.float64)
+        self.head = 0
+        self.steps = 0
+        self.start = start
+
+    # Move the window on by one hour for each new field
+    def _push(self, fields):
+        for field in fields:
+            self.total -= self.buffer[self.head]
+            self.buffer[self.head] = field
+            self.total += self.buffer[self.head]
+            self.head = (self.head + 1) % self.hours
+            self.start += datetime.timedelta(hours=1)
+            self.steps += 1
+        # Recalculate the sum occasionally, so rounding errors don't build up
+        if self.steps >= self.hours:
+            self.total = self.buffer.sum(axis=0, dtype=np.float64)
+            self.steps = 0
+
+    # Field at offset hours after the start of the window
+    def _slot(self, offset):
+        return self.buffer[(self.head + offset) % self.hours]
+
+    # Make the window cover dte-hours/2 to dte+hours/2-1 (hours).
+    #  If the new window overlaps the old one, only the new hours are loaded.
+    def centre_on(self, dte):
+        start = dte.replace(minute=0, second=0, microsecond=0) - datetime.timedelta(
+            hours=self.hours // 2
+        )
+        if self.start is None or start < self.start:
+            self._fill(start)
+            return
+        shift = int((start - self.start).total_seconds() // 3600)
+        if shift >= self.hours:
+            self._fill(start)
+        elif shift > 0:
+            new = load_range(
+                self.variable,
+                self.start + datetime.timedelta(hours=self.hours),
+                start + datetime.timedelta(hours=self.hours - 1),
+            )
+            if new.shape[0] != shift:
+                raise Exception(
+                    "Only %d of %d new hours of %s data from %s"
+                    % (
+                        new.shape[0],
+                        shift,
+                        self.variable,
+                        self.start + datetime.timedelta(hours=self.hours),
+                    )
+                )
+            self._push(new.data)
+
+    # The field at time dte (must be in the window)
+    def field(self, dte):
+        offset = int((dte - self.start).total_seconds() // 3600)
+        if offset < 0 or offset >= self.hours:
+            raise Exception("%s is not in the current window" % dte)
+        return self.template.copy(data=self._slot(offset).copy())
+
+    # Mean over the window
+    def mean(self):
+        return self.template.copy(data=self.total / self.hours)
+
+    # Diurnal composite - mean of the fields at the same time of day
+    #  as the window centre, over ndays days starting ndays/2 days before it.
+    def diurnal_mean(self, ndays=4):
+        first = self.hours // 2 - 24 * (ndays // 2)
+        if first < 0 or first + 24 * (ndays - 1) >= self.hours:
+            raise Exception("Window is too short for a %d day composite" % ndays)
+        self.composite[:] = self._slot(first)
+        for day in range(1, ndays):
+            self.composite += self._slot(first + 24 * day)
+        self.composite /= ndays
+        return self.template.copy(data=self.composite.copy())
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+# Convert ERA5 hourly NetCDF files into the memory-mappable binary store.
+#  Every month in one year (or just one month)
+
+import os
+import argparse
+from get_data.ERA5_hourly.ERA5_hourly import (
+    write_binary_store,
+    have_binary_store,
+)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--variable", help="Variable name", type=str, required=True)
+parser.add_argument("--year", help="Year", type=int, required=True)
+parser.add_argument(
+    "--month",
+    help="Integer month (default all)",
+    type=int,
+    default=None,
+    required=False,
+)
+args = parser.parse_args()
+
+months = range(1, 13)
+if args.month is not None:
+    months = [args.month]
+
+for month in months:
+    fname = "%s/ERA5/hourly/reanalysis/%04d/%02d/%s.nc" % (
+        os.getenv("SCRATCH"),
+        args.year,
+        month,
+        args.variable,
+    )
+    if not os.path.isfile(fname):
+        print("No data file %s, skipping" % fname)
+        continue
+    if have_binary_store(args.variable, args.year, month):
+        print("%s already converted, skipping" % fname)
+        continue
+    print("Converting %s for %04d-%02d" % (args.variable, args.year, month))
+    write_binary_store(args.variable, args.year, month)
@@ -0,0 +1,95 @@
+# Tests for the binary store: a converted month must give the same data
+#  as its NetCDF file, and load_range must work across the boundary between
+#  a converted month and an unconverted one.
+# Run with pytest - the data are small synthetic months, made under a
+#  temporary $SCRATCH.
+
+import os
+import datetime
+import numpy as np
+import netCDF4
+import pytest
+
+from get_data.ERA5_hourly import ERA5_hourly
+
+
+# Write a month of synthetic hourly data. Packed as int16, with a scale
+#  factor and offset (as the ERA5 files are), it loads as float64.
+def make_month(variable, year, month, packed=True):
+    start = datetime.datetime(year, month, 1)
+    if month == 12:
+        end = datetime.datetime(year + 1, 1, 1)
+    else:
+        end = datetime.datetime(year, month + 1, 1)
+    nhours = int((end - start).total_seconds() // 3600)
+    fname = "%s/ERA5/hourly/reanalysis/%04d/%02d/%s.nc" % (
+        os.getenv("SCRATCH"),
+        year,
+        month,
+        variable,
+    )
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    with netCDF4.Dataset(fname, "w") as ds:
+        ds.createDimension("time", nhours)
+        ds.createDimension("latitude", 5)
+        ds.createDimension("longitude", 8)
+        time = ds.createVariable("time", "f8", ("time",))
+        time.units = "hours since 1900-01-01 00:00:00.0"
+        time.calendar = "gregorian"
+        time.standard_name = "time"
+        time[:] = netCDF4.date2num(start, time.units) + np.arange(nhours)
+        latitude = ds.createVariable("latitude", "f4", ("latitude",))
+        latitude.units = "degrees_north"
+        latitude.standard_name = "latitude"
+        latitude[:] = np.linspace(90, -90, 5)
+        longitude = ds.createVariable("longitude", "f4", ("longitude",))
+        longitude.units = "degrees_east"
+        longitude.standard_name = "longitude"
+        longitude[:] = np.arange(0, 360, 45.0)
+        if packed:
+            data = ds.createVariable("t2m", "i2", ("time", "latitude", "longitude"))
+            data.scale_factor = 0.003
+            data.add_offset = 250.0
+        else:
+            data = ds.createVariable("t2m", "f4", ("time", "latitude", "longitude"))
+        data.units = "K"
+        data[:] = np.random.default_rng(month).random((nhours, 5, 8)) * 90 + 205
+
+
+@pytest.fixture
+def scratch(tmp_path, monkeypatch):
+    monkeypatch.setenv("SCRATCH", str(tmp_path))
+    ERA5_hourly.open_files.clear()
+    yield tmp_path
+    ERA5_hourly.open_files.clear()
+
+
+def test_binary_matches_netcdf(scratch):
+    make_month("2m_temperature", 2001, 2)
+    ERA5_hourly.write_binary_store("2m_temperature", 2001, 2)
+    assert ERA5_hourly.have_binary_store("2m_temperature", 2001, 2)
+    netcdf = ERA5_hourly.load("2m_temperature", 2001, 2, 10, 5, backend="netcdf")
+    binary = ERA5_hourly.load("2m_temperature", 2001, 2, 10, 5, backend="binary")
+    assert netcdf.dtype == np.float64
+    assert binary.dtype == netcdf.dtype
+    assert np.array_equal(binary.data, netcdf.data)
+
+
+# February converted, March not - and March either packed (float64, like
+#  February) or unpacked float32, so the months' dtypes differ
+@pytest.mark.parametrize("march_packed", [True, False])
+def test_load_range_across_converted_boundary(scratch, march_packed):
+    make_month("2m_temperature", 2001, 2)
+    make_month("2m_temperature", 2001, 3, packed=march_packed)
+    ERA5_hourly.write_binary_store("2m_temperature", 2001, 2)
+    assert ERA5_hourly.have_binary_store("2m_temperature", 2001, 2)
+    assert not ERA5_hourly.have_binary_store("2m_temperature", 2001, 3)
+    start = datetime.datetime(2001, 2, 27, 5)
+    end = datetime.datetime(2001, 3, 2, 20)
+    mixed = ERA5_hourly.load_range("2m_temperature", start, end)
+    netcdf = ERA5_hourly.load_range("2m_temperature", start, end, backend="netcdf")
+    assert mixed.shape == (88, 5, 8)
+    assert mixed.dtype == np.float64
+    assert mixed.dtype == netcdf.dtype
+    assert np.array_equal(mixed.data, netcdf.data)
+    assert np.array_equal(mixed.coord("time").points, netcdf.coord("time").points)
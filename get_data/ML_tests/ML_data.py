@@ -1,6 +1,8 @@
 # Functions to load The ML precipitation data
 
 import os
+import hashlib
+import collections
 import iris
 import iris.cube
 import iris.coords
@@ -66,7 +68,145 @@ def get_land_mask(grid=default_cube):
     return land_mask
 
 
-def load_daily(
+# Nearest-neighbour regridding onto a plot grid, with the points outside the
+#  source grid masked. Which source point each grid point takes its value
+#  from, and which grid points are outside the source grid, only depend on
+#  the two grids. So work them out once (and keep them on disk), and then
+#  regridding a field is just a np.take.
+nearest_maps = {}
+
+
+# A name for the grid of one or more cubes
+def grid_key(*cubes):
+    key = hashlib.sha1()
+    for cube in cubes:
+        for name in ("grid_latitude", "grid_longitude"):
+            coord = cube.coord(name)
+            key.update(coord.points.tobytes())
+            key.update(
+                repr(
+                    (
+                        coord.points.dtype,
+                        coord.circular,
+                        coord.units,
+                        coord.coord_system,
+                    )
+                ).encode()
+            )
+    return key.hexdigest()
+
+
+# Use Iris to regrid the index of each source point - so the source point
+#  chosen for each grid point is exactly what iris.analysis.Nearest picks.
+def make_nearest_map(source, grid):
+    source_index = source.copy(data=np.arange(source.data.size).reshape(source.shape))
+    index = source_index.regrid(grid, iris.analysis.Nearest())
+    lat = source.coord("grid_latitude").points
+    lon = source.coord("grid_longitude").points
+    latlon = np.meshgrid(
+        index.coord("grid_longitude").points, index.coord("grid_latitude").points
+    )
+    outside = (
+        (latlon[0] < lon.min())
+        | (latlon[0] > lon.max())
+        | (latlon[1] < lat.min())
+        | (latlon[1] > lat.max())
+    )
+    return (index.data.astype(np.int32), outside)
+
+
+def nearest_map(source, grid):
+    key = grid_key(source, grid)
+    if key not in nearest_maps:
+        cache_file = "%s/AnimH/ML_data/nearest_%s.npz" % (os.getenv("SCRATCH"), key)
+        if os.path.isfile(cache_file):
+            with np.load(cache_file) as cached:
+                nearest_maps[key] = (cached["index"], cached["outside"])
+        else:
+            index, outside = make_nearest_map(source, grid)
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            # Write to a temporary file, and rename when complete, so
+            #  parallel jobs never load a partial file.
+            np.savez("%s.tmp.npz" % cache_file, index=index, outside=outside)
+            os.replace("%s.tmp.npz" % cache_file, cache_file)
+            nearest_maps[key] = (index, outside)
+    return nearest_maps[key]
+
+
+def regrid_nearest(varC, grid):
+    index, outside = nearest_map(varC, grid)
+    regridded = iris.cube.Cube(
+        np.ma.masked_where(outside, np.take(varC.data, index)),
+        dim_coords_and_dims=[
+            (grid.coord("grid_latitude").copy(), 0),
+            (grid.coord("grid_longitude").copy(), 1),
+        ],
+    )
+    regridded.metadata = varC.metadata
+    for coord in varC.coords(dim_coords=False):
+        if len(varC.coord_dims(coord)) == 0:
+            regridded.add_aux_coord(coord.copy())
+    return regridded
+
+
+# Files, once opened, are kept - with their cubes (lazily loaded, so only
+#  the fields asked for are read) and an index of the cube times. So each
+#  file's metadata are parsed only once, and finding a field is a dictionary
+#  lookup instead of a scan through all the times. The least recently used
+#  files are dropped when more than max_open are in use.
+class FilePool:
+    def __init__(self, max_open=8):
+        self.max_open = max_open
+        self.files = collections.OrderedDict()
+
+    # The named cube from file fname, with dictionaries mapping its times
+    #  to indices along the time dimension - by day (year, month, day)
+    #  and by hour (year, month, day, hour).
+    def get(self, fname, name):
+        if fname not in self.files:
+            self.files[fname] = {}
+            while len(self.files) > self.max_open:
+                self.files.popitem(last=False)
+        self.files.move_to_end(fname)
+        cubes = self.files[fname]
+        if name not in cubes:
+            cube = iris.load_cube(
+                fname, iris.Constraint(cube_func=lambda cube: cube.name() == name)
+            )
+            by_day = {}
+            by_hour = {}
+            for index, cell in enumerate(cube.coord("time").cells()):
+                by_day[(cell.point.year, cell.point.month, cell.point.day)] = index
+                by_hour[
+                    (cell.point.year, cell.point.month, cell.point.day, cell.point.hour)
+                ] = index
+            cubes[name] = (cube, {3: by_day, 4: by_hour})
+        return cubes[name]
+
+    def clear(self):
+        self.files.clear()
+
+
+file_pool = FilePool()
+
+
+# The field at the given time - (year, month, day) or (year, month, day, hour) -
+#  from the named cube in file fname (and for the given member, if any).
+def load_field(fname, name, time, member=None):
+    cube, times = file_pool.get(fname, name)
+    if time not in times[len(time)]:
+        raise Exception("No %s data for %s in %s" % (name, time, fname))
+    index = [slice(None)] * cube.ndim
+    index[cube.coord_dims("time")[0]] = times[len(time)][time]
+    if member is not None:
+        members = cube.coord("member")
+        if member not in members.points:
+            raise Exception("No member %d in %s" % (member, fname))
+        index[cube.coord_dims(members)[0]] = np.where(members.points == member)[0][0]
+    return cube[tuple(index)]
+
+
+def read_daily(
     model="target",
     year=None,
     month=None,
@@ -76,41 +216,18 @@ def load_daily(
 ):
     if year is None or month is None or day is None:
         raise Exception("Year, month, and day, must be specified")
-    c1 = iris.Constraint(
-        time=lambda cell: cell.point.year == year
-        and cell.point.month == month
-        and cell.point.day == day
-    )
-    c2 = iris.Constraint(member=lambda cell: cell.point == member)
     if model == "target":
         fname = "%s/predictions_mse_corrected_structure.nc" % Ddir
-        c3 = iris.Constraint(cube_func=lambda cube: cube.name() == "target")
-        varC = iris.load_cube(
-            fname,
-            c1 & c2 & c3,
-        )
+        varC = load_field(fname, "target", (year, month, day), member)
     elif model == "unet-mse":
         fname = "%s/predictions_mse_corrected_structure.nc" % Ddir
-        c3 = iris.Constraint(cube_func=lambda cube: cube.name() == "prediction")
-        varC = iris.load_cube(
-            fname,
-            c1 & c2 & c3,
-        )
+        varC = load_field(fname, "prediction", (year, month, day), member)
     elif model == "unet-asym":
         fname = "%s/predictions_emulasym_corrected_structure.nc" % Ddir
-        c3 = iris.Constraint(cube_func=lambda cube: cube.name() == "prediction")
-        varC = iris.load_cube(
-            fname,
-            c1 & c2 & c3,
-        )
+        varC = load_field(fname, "prediction", (year, month, day), member)
     elif model == "diffusion":
         fname = "%s/predictions-ensemble01-sample0_Diffusion.nc" % Ddir
-        c2 = iris.Constraint()
-        c3 = iris.Constraint(cube_func=lambda cube: cube.name() == "pred_pr")
-        varC = iris.load_cube(
-            fname,
-            c1 & c2 & c3,
-        )
+        varC = load_field(fname, "pred_pr", (year, month, day))
         varC.coord("ensemble_member").points = 1  # Hackety hack
         varC = iris.util.squeeze(varC)
         varC.data *= 86400.0  # Convert from m/s to m/day
@@ -118,24 +235,61 @@ def load_daily(
         raise Exception("Unknown model %s" % model)
     add_coord_system(varC)
     if grid is not None:  # Regrid, but mask out areas outside original grid
-        lat_max = varC.coord("grid_latitude").points.max()
-        lat_min = varC.coord("grid_latitude").points.min()
-        lon_max = varC.coord("grid_longitude").points.max()
-        lon_min = varC.coord("grid_longitude").points.min()
-        varC = varC.regrid(grid, iris.analysis.Nearest())
-        latlon = np.meshgrid(
-            varC.coord("grid_longitude").points, varC.coord("grid_latitude").points
-        )
-        varC.data = np.ma.masked_where(
-            (latlon[0] < lon_min)
-            | (latlon[0] > lon_max)
-            | (latlon[1] < lat_min)
-            | (latlon[1] > lat_max),
-            varC.data,
-        )
+        varC = regrid_nearest(varC, grid)
     return varC
 
 
+# Loaded (and regridded) daily fields are kept for reuse - each one is
+#  needed for about 24 hourly frames. The least recently used fields are
+#  dropped when the cache goes over its memory budget.
+class DailyCache:
+    def __init__(self, max_bytes=1024**3):
+        self.max_bytes = max_bytes
+        self.fields = collections.OrderedDict()
+        self.nbytes = 0
+
+    def get(self, key):
+        if key not in self.fields:
+            return None
+        self.fields.move_to_end(key)
+        return self.fields[key]
+
+    def put(self, key, cube):
+        if key in self.fields:
+            self.nbytes -= self.fields[key].data.nbytes
+        self.fields[key] = cube
+        self.fields.move_to_end(key)
+        self.nbytes += cube.data.nbytes
+        while self.nbytes > self.max_bytes and len(self.fields) > 1:
+            dropped = self.fields.popitem(last=False)[1]
+            self.nbytes -= dropped.data.nbytes
+
+    def clear(self):
+        self.fields.clear()
+        self.nbytes = 0
+
+
+daily_cache = DailyCache()
+
+
+def load_daily(
+    model="target",
+    year=None,
+    month=None,
+    day=None,
+    member=1,
+    grid=default_cube,
+):
+    if year is None or month is None or day is None:
+        raise Exception("Year, month, and day, must be specified")
+    key = (model, year, month, day, member, None if grid is None else grid_key(grid))
+    varC = daily_cache.get(key)
+    if varC is None:
+        varC = read_daily(model, year, month, day, member, grid)
+        daily_cache.put(key, varC)
+    return varC.copy()
+
+
 # Switch dates using cftime
 
 
@@ -188,6 +342,67 @@ def load(
         return interpolated
 
 
+# All 24 hourly fields from 12:00 on the given day to 11:00 on the next day,
+#  interpolated (in one go) between the two daily fields.
+def load_hourly(
+    model="target",
+    year=None,
+    month=None,
+    day=None,
+    member=1,
+    grid=default_cube,
+):
+    if year is None or month is None or day is None:
+        raise Exception("Year, month, and day, must be specified")
+    today = load_daily(model, year, month, day, member, grid)
+    current_date = cftime.datetime(year, month, day, 12, calendar="360_day")
+    next_day = current_date + datetime.timedelta(days=1)
+    next = load_daily(model, next_day.year, next_day.month, next_day.day, member, grid)
+    f = iris.cube.CubeList([today, next])
+    f = f.merge_cube()
+    interpolated = f.interpolate(
+        [
+            (
+                "time",
+                [
+                    current_date + datetime.timedelta(hours=hour)
+                    for hour in range(1, 24)
+                ],
+            )
+        ],
+        iris.analysis.Linear(),
+    )
+    return [today] + list(interpolated.slices_over("time"))
+
+
+# Hourly fields for a run of frames, one hour apart, starting at start.
+#  A generator, yielding (date, field) for each frame. The hourly fields
+#  for each 12:00-to-12:00 period are made in one go, with load_hourly.
+def load_hourly_sequence(
+    model="target",
+    start=None,
+    nframes=1,
+    member=1,
+    grid=default_cube,
+):
+    if start is None:
+        raise Exception("Start date must be specified")
+    fields = None
+    first = None
+    for i in range(nframes):
+        date = start + datetime.timedelta(hours=i)
+        # Start of the 24-hour period the date is in
+        period = date.replace(hour=12, minute=0)
+        if date.hour < 12:
+            period = period - datetime.timedelta(days=1)
+        if period != first:
+            fields = load_hourly(
+                model, period.year, period.month, period.day, member, grid
+            )
+            first = period
+        yield (date, fields[(date.hour - 12) % 24])
+
+
 def load_3hr(
     model="target",
     year=None,
@@ -204,39 +419,15 @@ def load_3hr(
     fname = (
         "/data/scratch/tomas.wetherell/create_dataset/01/3hrinst_dataset_%04d.nc" % fyr
     )
-    c1 = iris.Constraint(
-        time=lambda cell: cell.point.year == year
-        and cell.point.month == month
-        and cell.point.day == day
-        and cell.point.hour == hour
-    )
     if model == "target":
-        c3 = iris.Constraint(cube_func=lambda cube: cube.name() == "precipitation_flux")
-        varC = iris.load_cube(
-            fname,
-            c1 & c3,
-        )
+        varC = load_field(fname, "precipitation_flux", (year, month, day, hour))
         varC = iris.util.squeeze(varC)
         varC.data = varC.data * 86400.0  # Convert from m/s to m/day
     else:
         raise Exception("Unknown model %s" % model)
     add_coord_system(varC)
     if grid is not None:  # Regrid, but mask out areas outside original grid
-        lat_max = varC.coord("grid_latitude").points.max()
-        lat_min = varC.coord("grid_latitude").points.min()
-        lon_max = varC.coord("grid_longitude").points.max()
-        lon_min = varC.coord("grid_longitude").points.min()
-        varC = varC.regrid(grid, iris.analysis.Nearest())
-        latlon = np.meshgrid(
-            varC.coord("grid_longitude").points, varC.coord("grid_latitude").points
-        )
-        varC.data = np.ma.masked_where(
-            (latlon[0] < lon_min)
-            | (latlon[0] > lon_max)
-            | (latlon[1] < lat_min)
-            | (latlon[1] > lat_max),
-            varC.data,
-        )
+        varC = regrid_nearest(varC, grid)
     return varC
 
 
@@ -271,3 +462,52 @@ def load_3hr_i(
     f = f.merge_cube()
     interpolated = f.interpolate([("time", current_date)], iris.analysis.Linear())
     return interpolated
+
+
+# A run of nframes 3-hourly fields interpolated to every step minutes,
+#  starting at start (a 360_day cftime.datetime), generated in order as
+#  (date, field) pairs. Each 3-hourly field is loaded only once, and all the
+#  frames between a pair of them are interpolated in one go.
+def load_3hr_sequence(
+    model="target",
+    start=None,
+    nframes=1,
+    step=15,
+    grid=default_cube,
+):
+    if start is None:
+        raise Exception("Start date must be specified")
+    dates = [start + datetime.timedelta(minutes=step * i) for i in range(nframes)]
+    b_field = None
+    b_date = None
+    i = 0
+    while i < len(dates):
+        # The pair of 3-hourly fields around the next date
+        first = dates[i].replace(hour=dates[i].hour - dates[i].hour % 3, minute=0)
+        e_date = first + datetime.timedelta(hours=3)
+        if b_date != first:
+            b_field = load_3hr(
+                model, first.year, first.month, first.day, first.hour, grid
+            )
+            b_date = first
+        interval = []
+        while i < len(dates) and dates[i] < e_date:
+            interval.append(dates[i])
+            i += 1
+        between = [date for date in interval if date != b_date]
+        if len(between) > 0:
+            e_field = load_3hr(
+                model, e_date.year, e_date.month, e_date.day, e_date.hour, grid
+            )
+            f = iris.cube.CubeList([b_field, e_field])
+            f = f.merge_cube()
+            interpolated = f.interpolate([("time", between)], iris.analysis.Linear())
+            interpolated = list(interpolated.slices_over("time"))
+        for date in interval:
+            if date == b_date:
+                yield (date, b_field.copy())
+            else:
+                yield (date, interpolated.pop(0))
+        if len(between) > 0:  # The end of this interval is the start of the next
+            b_field = e_field
+            b_date = e_date
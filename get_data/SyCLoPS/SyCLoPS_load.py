@@ -3,66 +3,288 @@
 tracks_file = (
     "/data/users/malcolm.roberts/SyCLoPS_REV/ERA5_SyCLoPS_classified_2020-21_subset.csv"
 )
-# Load the contents of the tracks file using the csv module
-import csv
+import os
+import bisect
 import datetime
+from collections.abc import Mapping
 import iris.analysis.cartography
 import numpy as np
+import pandas
 
+# Columns in the tracks file stored as numbers. All the other columns
+#  (except TID and ISOTIME) are kept as strings, as they are in the file.
+numeric_columns = ("LON", "LAT", "MSLP", "WS", "Tropical_Flag", "Transition_Zone")
+label_columns = ("Full_Name", "Short_Label", "Track_Info")  # Always present
 
-# Convert the list of lists into a list of dictionaries
-# (assuming the first row contains the column names)
-def load_tracks():
-    with open(tracks_file, "r") as f:
-        reader = csv.DictReader(f)
-        # Read the rest of the rows into a list
-        data = list(reader)
-    # Convert the dates to datetime objects
-    for row in data:
-        row["datetime"] = datetime.datetime.strptime(
-            row["ISOTIME"], "%Y-%m-%d %H:%M:%S"
+# Times are stored as integer seconds since this date
+epoch = datetime.datetime(1970, 1, 1)
+
+
+def to_seconds(dte):
+    return int((dte - epoch).total_seconds())
+
+
+def from_seconds(seconds):
+    return epoch + datetime.timedelta(seconds=int(seconds))
+
+
+# All the track points, stored as columns (one numpy array per field),
+#  sorted by track and then by time. Points offsets[i] to offsets[i+1]
+#  belong to track tids[i].
+class TrackStore:
+    def __init__(self, tids, offsets, time, columns, labels):
+        self.tids = tids  # Track IDs (strings)
+        self.offsets = offsets  # int64, length ntracks+1
+        self.time = time  # int64 seconds since epoch
+        self.columns = columns  # name -> float64 array
+        self.labels = labels  # name -> (int32 codes, array of label strings)
+        self.tid_index = {tid: i for i, tid in enumerate(tids)}
+        self.rotations = {}  # Rotated copies, by projection
+        self.key = None  # Sorted (track, time) search key - made when needed
+
+    def __len__(self):
+        return len(self.tids)
+
+    # Point-by-point copy of one track, as a list of dictionaries
+    def track(self, i):
+        tid = self.tids[i]
+        points = []
+        for j in range(self.offsets[i], self.offsets[i + 1]):
+            point = {"TID": tid, "datetime": from_seconds(self.time[j])}
+            point["ISOTIME"] = point["datetime"].strftime("%Y-%m-%d %H:%M:%S")
+            for key, values in self.columns.items():
+                point[key] = float(values[j])
+            for key, (codes, names) in self.labels.items():
+                point[key] = str(names[codes[j]])
+            points.append(point)
+        return points
+
+    # Make a single sorted key for searching on (track, time)
+    def make_key(self):
+        self.t_min = self.time.min()
+        self.span = self.time.max() - self.t_min + 2
+        track = np.repeat(np.arange(len(self.tids)), np.diff(self.offsets))
+        self.key = track * self.span + (self.time - self.t_min)
+
+    # Interpolate tracks to times, all at once. tracks (track indices) and
+    #  times (seconds since epoch) are arrays or scalars, broadcast together.
+    #  Returns a dictionary of arrays, one entry for each (track, time) pair -
+    #  "valid" is False where the track doesn't span the time.
+    def interpolate(self, tracks, times):
+        tracks, times = np.broadcast_arrays(
+            np.atleast_1d(np.asarray(tracks, dtype=np.int64)),
+            np.atleast_1d(np.asarray(times, dtype=np.int64)),
+        )
+        if self.key is None:
+            self.make_key()
+        # Last point at or before the time, and first point after it
+        t = np.clip(times, self.t_min - 1, self.t_min + self.span - 2)
+        before = (
+            np.searchsorted(self.key, tracks * self.span + (t - self.t_min), "right")
+            - 1
+        )
+        valid = (before >= self.offsets[tracks]) & (
+            before + 1 < self.offsets[tracks + 1]
+        )
+        before = np.where(valid, before, self.offsets[tracks])
+        after = np.where(valid, before + 1, self.offsets[tracks])
+        weight = (times - self.time[before]) / np.maximum(
+            self.time[after] - self.time[before], 1
         )
-    # Convert numeric values to floats
-    for row in data:
-        for key in ("LON", "LAT", "MSLP", "WS", "Tropical_Flag", "Transition_Zone"):
-            try:
-                row[key] = float(row[key])
-            except ValueError:
-                pass
-    # Mke sure the longitude is in the range -180 to 180
-    for row in data:
-        if row["LON"] > 180:
-            row["LON"] -= 360
-        elif row["LON"] < -180:
-            row["LON"] += 360
-    # Subset points by cyclone ID
-    tracks_by_tid = {}
-    for point in data:
-        tid = point["TID"]  # Assuming 'TID' is the column name
-
-        if tid not in tracks_by_tid:
-            tracks_by_tid[tid] = []
-
-        tracks_by_tid[tid].append(point)
-    return tracks_by_tid
+        result = {"track": tracks, "time": times, "valid": valid}
+        for key, values in self.columns.items():
+            change = values[after] - values[before]
+            if key == "LON":  # Take the short way round
+                change[change > 180] -= 360
+                change[change < -180] += 360
+            result[key] = values[before] + change * weight
+            if key == "LON":
+                result[key][result[key] > 180] -= 360
+                result[key][result[key] < -180] += 360
+        # Labels come from the point after
+        for key, (codes, names) in self.labels.items():
+            result[key] = names[codes[after]]
+        return result
+
+    # Convert the output of interpolate into a list of point dictionaries
+    #  (leaving out the invalid ones)
+    def points(self, result):
+        points = []
+        for n in np.flatnonzero(result["valid"]):
+            point = {
+                "TID": self.tids[result["track"][n]],
+                "datetime": from_seconds(result["time"][n]),
+            }
+            for key in self.columns:
+                point[key] = float(result[key][n])
+            for key in self.labels:
+                point[key] = str(result[key][n])
+            points.append(point)
+        return points
+
+    def save(self, fname):
+        arrays = {"tids": self.tids, "offsets": self.offsets, "time": self.time}
+        for key, values in self.columns.items():
+            arrays["column_%s" % key] = values
+        for key, (codes, names) in self.labels.items():
+            arrays["codes_%s" % key] = codes
+            arrays["names_%s" % key] = names
+        arrays["label_keys"] = np.array(list(self.labels), dtype=str)
+        # Write to a temporary file, and rename when complete, so a
+        #  concurrent load never sees a partial file.
+        np.savez("%s.tmp.npz" % fname, **arrays)
+        os.replace("%s.tmp.npz" % fname, fname)
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as f:
+            if "label_keys" not in f.files:
+                raise Exception("%s has no list of label columns" % fname)
+            columns = {key: f["column_%s" % key] for key in numeric_columns}
+            labels = {
+                str(key): (f["codes_%s" % key], f["names_%s" % key])
+                for key in f["label_keys"]
+            }
+            return cls(f["tids"], f["offsets"], f["time"], columns, labels)
+
+
+# Parse the tracks file into a TrackStore
+def read_tracks_file(fname=tracks_file):
+    # Everything read as strings, so the columns not converted to numbers
+    #  keep their values exactly as they are in the file
+    data = pandas.read_csv(fname, dtype=str, keep_default_na=False)
+    data.columns = ["" if key.startswith("Unnamed: ") else key for key in data.columns]
+    for key in ("TID", "ISOTIME") + numeric_columns + label_columns:
+        if key not in data.columns:
+            raise Exception("No %s column in %s" % (key, fname))
+    time = (
+        pandas.to_datetime(data["ISOTIME"], format="%Y-%m-%d %H:%M:%S")
+        .to_numpy()
+        .astype("datetime64[s]")
+        .astype(np.int64)
+    )
+    # Track IDs in order of first appearance
+    tid_codes, tids = pandas.factorize(data["TID"])
+    # Sort by track, then by time
+    order = np.lexsort((time, tid_codes))
+    counts = np.bincount(tid_codes, minlength=len(tids))
+    offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+    columns = {}
+    for key in numeric_columns:
+        columns[key] = pandas.to_numeric(data[key], errors="coerce").to_numpy(
+            dtype=np.float64
+        )[order]
+    # Make sure the longitude is in the range -180 to 180
+    lon = columns["LON"]
+    lon[lon > 180] -= 360
+    lon[lon < -180] += 360
+    labels = {}
+    for key in data.columns:
+        if key in ("TID", "ISOTIME") or key in numeric_columns:
+            continue
+        codes, names = pandas.factorize(data[key])
+        labels[key] = (codes.astype(np.int32)[order], np.asarray(names, dtype=str))
+    return TrackStore(
+        np.asarray(tids, dtype=str), offsets, time[order], columns, labels
+    )
+
+
+# Get the TrackStore for a tracks file - from a cached copy if there is
+#  an up-to-date one, otherwise parse the file (and cache the result).
+def load_track_store(fname=tracks_file):
+    cache_file = "%s/AnimH/SyCLoPS/%s.npz" % (
+        os.getenv("SCRATCH"),
+        os.path.splitext(os.path.basename(fname))[0],
+    )
+    if os.path.isfile(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(
+        fname
+    ):
+        try:
+            return TrackStore.load(cache_file)
+        except Exception:
+            pass  # Cache from an older version - remake it
+    store = read_tracks_file(fname)
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    store.save(cache_file)
+    return store
+
+
+# Dictionary-like view of a TrackStore: tracks[tid] is a list of
+#  point dictionaries (made when first asked for, and then kept).
+class Tracks(Mapping):
+    def __init__(self, store):
+        self.store = store
+        self.cache = {}
+
+    def __getitem__(self, tid):
+        if tid not in self.cache:
+            self.cache[tid] = self.store.track(self.store.tid_index[tid])
+        return self.cache[tid]
+
+    def __iter__(self):
+        return iter(self.store.tids)
+
+    def __len__(self):
+        return len(self.store)
+
+
+# Load the tracks as a dictionary of lists of dictionaries
+#  (one dictionary for each point, one list for each cyclone ID)
+def load_tracks(fname=tracks_file):
+    return Tracks(load_track_store(fname))
+
+
+# Rotate the pole for arrays of points (all at once)
+def rotate_points(lon, lat, pole_longitude, pole_latitude, npg_longitude):
+    rp = iris.analysis.cartography.rotate_pole(
+        np.asarray(lon, dtype=np.float64),
+        np.asarray(lat, dtype=np.float64),
+        pole_longitude,
+        pole_latitude,
+    )
+    r_lon = rp[0] + npg_longitude
+    r_lon[r_lon > 180] -= 360
+    r_lon[r_lon < -180] += 360
+    return (r_lon, rp[1])
+
+
+# Rotate all the points in a TrackStore. The rotated copy is kept, so
+#  asking again for the same projection costs nothing.
+def rotate_store(store, pole_longitude, pole_latitude, npg_longitude):
+    projection = (pole_longitude, pole_latitude, npg_longitude)
+    if projection not in store.rotations:
+        columns = dict(store.columns)
+        columns["LON"], columns["LAT"] = rotate_points(
+            store.columns["LON"],
+            store.columns["LAT"],
+            pole_longitude,
+            pole_latitude,
+            npg_longitude,
+        )
+        store.rotations[projection] = TrackStore(
+            store.tids, store.offsets, store.time, columns, store.labels
+        )
+    return store.rotations[projection]
 
 
 # Rotate the pole
 def rotate_pole(tracks, pole_longitude, pole_latitude, npg_longitude):
-    for tid, track in tracks.items():
-        for point in track:
-            rp = iris.analysis.cartography.rotate_pole(
-                np.array(point["LON"]),
-                np.array(point["LAT"]),
-                pole_longitude,
-                pole_latitude,
-            )
-            point["LON"] = rp[0][0] + npg_longitude
-            if point["LON"] > 180:
-                point["LON"] -= 360
-            elif point["LON"] < -180:
-                point["LON"] += 360
-            point["LAT"] = rp[1][0]
+    if isinstance(tracks, Tracks):
+        return Tracks(
+            rotate_store(tracks.store, pole_longitude, pole_latitude, npg_longitude)
+        )
+    # Plain dictionary of point lists - rotate all the points in place
+    points = [point for track in tracks.values() for point in track]
+    lon, lat = rotate_points(
+        [point["LON"] for point in points],
+        [point["LAT"] for point in points],
+        pole_longitude,
+        pole_latitude,
+        npg_longitude,
+    )
+    for point, p_lon, p_lat in zip(points, lon, lat):
+        point["LON"] = float(p_lon)
+        point["LAT"] = float(p_lat)
     return tracks
 
 
@@ -83,49 +305,136 @@ def first_date(track):
     return start_time
 
 
+# Index of track lifetimes, for finding the tracks active near a given time.
+#  Each track is listed in every time bin (default 1 day) that its lifetime,
+#  extended by margin at each end, overlaps - so a query only has to check
+#  the tracks listed in one bin, however long the catalogue is.
+class TrackIndex:
+    def __init__(
+        self,
+        store,
+        margin=datetime.timedelta(hours=12),
+        bin_size=datetime.timedelta(days=1),
+    ):
+        self.start = store.time[store.offsets[:-1]]
+        self.end = store.time[store.offsets[1:] - 1]
+        self.margin = int(margin.total_seconds())
+        self.bin_size = int(bin_size.total_seconds())
+        first_bin = (self.start - self.margin) // self.bin_size
+        last_bin = (self.end + self.margin) // self.bin_size
+        self.first_bin = first_bin.min()
+        self.nbins = last_bin.max() - self.first_bin + 1
+        # One entry for each (track, bin) pair, sorted by bin
+        counts = last_bin - first_bin + 1
+        tracks = np.repeat(np.arange(len(counts)), counts)
+        bins = np.repeat(first_bin - self.first_bin, counts) + (
+            np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        )
+        order = np.argsort(bins, kind="stable")
+        self.members = tracks[order]
+        self.bin_offsets = np.concatenate(
+            ([0], np.cumsum(np.bincount(bins, minlength=self.nbins)))
+        )
+
+    # Find the tracks that are active at time dte (start <= dte < end),
+    #  that ended less than margin before it, and that start less than margin
+    #  after it. Returns three arrays of track indices (in store order).
+    def query(self, dte):
+        t = to_seconds(dte)
+        b = t // self.bin_size - self.first_bin
+        if b < 0 or b >= self.nbins:
+            empty = np.zeros(0, dtype=np.int64)
+            return (empty, empty, empty)
+        candidates = self.members[self.bin_offsets[b] : self.bin_offsets[b + 1]]
+        start = self.start[candidates]
+        end = self.end[candidates]
+        active = candidates[(start <= t) & (t < end)]
+        ended = candidates[(end <= t) & (t < end + self.margin)]
+        starting = candidates[(t < start) & (start < t + self.margin)]
+        return (active, ended, starting)
+
+
+# Tracks resampled to every whole hour, for making trails. Each track is
+#  resampled once, when first needed, and kept until a frame doesn't use it.
+class HourlyTrails:
+    def __init__(self, store):
+        self.store = store
+        self.resampled = {}  # Track index -> interpolate() output
+        self.used = set()  # Tracks used since the last call to forget_unused
+
+    def resample(self, i):
+        first = self.store.time[self.store.offsets[i]]
+        last = self.store.time[self.store.offsets[i + 1] - 1]
+        hours = np.arange(-(-first // 3600) * 3600, last, 3600)
+        return self.store.interpolate(i, hours)
+
+    # Trail of track i at time dte - the track at dte, and at every whole
+    #  hour before it back to the start of the track (most recent first).
+    #  Returns a dictionary of arrays (as interpolate does).
+    def trail(self, i, dte):
+        if i not in self.resampled:
+            self.resampled[i] = self.resample(i)
+        self.used.add(i)
+        resampled = self.resampled[i]
+        t = to_seconds(dte)
+        n = np.searchsorted(resampled["time"], t, "right")
+        trail = {key: values[:n][::-1] for key, values in resampled.items()}
+        if t % 3600 != 0:  # Add the point at dte itself
+            end = self.store.interpolate(i, t)
+            if end["valid"][0]:
+                for key in trail:
+                    trail[key] = np.concatenate((end[key], trail[key]))
+        return trail
+
+    # Drop the resampled tracks that haven't been used since the last call
+    def forget_unused(self):
+        self.resampled = {i: self.resampled[i] for i in self.used}
+        self.used = set()
+
+
 # Interpolate a track to a given time
+#  track is a list of dictionaries with 'datetime' and other fields,
+#  sorted by time. Returns None if the track doesn't span the time.
 def interpolate_track(track, target_time):
-    # Assuming track is a list of dictionaries with 'datetime' and other fields
     # Find the two points surrounding the target time
-    before = None
-    after = None
-
-    for point in track:
-        if point["datetime"] <= target_time:
-            before = point
-        elif point["datetime"] >= target_time and after is None:
-            after = point
-            break
-
-    if before is None or after is None:
+    j = bisect.bisect_right(track, target_time, key=lambda point: point["datetime"])
+    if j == 0 or j == len(track):
         return None  # Cannot interpolate if we don't have both points
-
-    if before["datetime"] == after["datetime"]:
-        return before
+    before = track[j - 1]
+    after = track[j]
+    weight = (target_time - before["datetime"]).total_seconds() / (
+        after["datetime"] - before["datetime"]
+    ).total_seconds()
 
     # Interpolate the numeric values
     interpolated_point = after.copy()
-    for key in ("LON", "LAT", "MSLP", "WS", "Tropical_Flag", "Transition_Zone"):
-        if key == "LON" and (after[key] - before[key]) > 180:
-            after[key] -= 360
-        if key == "LON" and (before[key] - after[key]) > 180:
-            before[key] -= 360
-        interpolated_point[key] = before[key] + (after[key] - before[key]) * (
-            (target_time - before["datetime"]).total_seconds()
-            / (after["datetime"] - before["datetime"]).total_seconds()
-        )
-        if key == "LON":
-            if interpolated_point[key] > 180:
-                interpolated_point[key] -= 360
-            elif interpolated_point[key] < -180:
-                interpolated_point[key] += 360
+    for key in numeric_columns:
+        change = after[key] - before[key]
+        if key == "LON":  # Take the short way round
+            if change > 180:
+                change -= 360
+            elif change < -180:
+                change += 360
+        interpolated_point[key] = before[key] + change * weight
+    if interpolated_point["LON"] > 180:
+        interpolated_point["LON"] -= 360
+    elif interpolated_point["LON"] < -180:
+        interpolated_point["LON"] += 360
 
     interpolated_point["datetime"] = target_time
     return interpolated_point
 
 
-# Make the trail of a cyclone
+# Make the trail of a cyclone - the track interpolated to every hour
+#  from target_time back to the start of the track (most recent first).
 def make_trail(tracks, tid, target_time):
+    if isinstance(tracks, Tracks):
+        store = tracks.store
+        i = store.tid_index[tid]
+        t = to_seconds(target_time)
+        start = min(t, store.time[store.offsets[i]])
+        times = np.arange(t, start - 1, -3600)
+        return store.points(store.interpolate(i, times))
     track = tracks[tid]
     start_time = target_time
     for point in track:
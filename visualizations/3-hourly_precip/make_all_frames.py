@@ -24,11 +24,33 @@ def is_done(year, month, day, hour, minute):
     return False
 
 
+# Each job makes a run of consecutive frames (one day) in one process
+frames_per_job = 96
+
+
+def job(start, nframes):
+    return (
+        "./make_frame.py --year=%d --month=%d "
+        + "--day=%d --hour=%d --minute=%d "
+        + "--nframes=%d"
+        + "\n"
+    ) % (
+        start.year,
+        start.month,
+        start.day,
+        start.hour,
+        start.minute,
+        nframes,
+    )
+
+
 f = open("run.txt", "w+")
 
 start_day = cftime.datetime(2021, 1, 1, 0, calendar="360_day")
 end_day = cftime.datetime(2021, 12, 30, 18, calendar="360_day")
 
+run_start = None
+nframes = 0
 current_day = start_day
 while current_day <= end_day:
     if is_done(
@@ -38,19 +60,19 @@ while current_day <= end_day:
         current_day.hour,
         current_day.minute,
     ):
+        if run_start is not None:
+            f.write(job(run_start, nframes))
+            run_start = None
         current_day = current_day + datetime.timedelta(minutes=15)
         continue
-    cmd = (
-        "./make_frame.py --year=%d --month=%d "
-        + "--day=%d --hour=%d --minute=%d"
-        + "\n"
-    ) % (
-        current_day.year,
-        current_day.month,
-        current_day.day,
-        current_day.hour,
-        current_day.minute,
-    )
-    f.write(cmd)
+    if run_start is None:
+        run_start = current_day
+        nframes = 0
+    nframes += 1
+    if nframes == frames_per_job:
+        f.write(job(run_start, nframes))
+        run_start = None
     current_day = current_day + datetime.timedelta(minutes=15)
+if run_start is not None:
+    f.write(job(run_start, nframes))
 f.close()
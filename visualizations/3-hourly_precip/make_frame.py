@@ -3,7 +3,8 @@
 # Target  3-hourly precip
 
 import os
-from get_data.ML_tests.ML_data import load_3hr_i, get_land_mask
+from get_data.ML_tests.ML_data import load_3hr_sequence, get_land_mask
+import cftime
 
 import matplotlib
 from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
@@ -26,6 +27,20 @@ parser.add_argument("--hour", help="Time of day (0 to 23)", type=int, required=T
 parser.add_argument(
     "--minute", help="Minute of hour (0 to 59)", type=int, default=0, required=False
 )
+parser.add_argument(
+    "--nframes",
+    help="Number of frames to make (all in this one process)",
+    default=1,
+    type=int,
+    required=False,
+)
+parser.add_argument(
+    "--step",
+    help="Time between frames (minutes)",
+    default=15,
+    type=int,
+    required=False,
+)
 
 parser.add_argument(
     "--opdir",
@@ -44,7 +59,16 @@ if not os.path.isdir(args.opdir):
     os.makedirs(args.opdir)
 
 
-target = load_3hr_i("target", args.year, args.month, args.day, args.hour, args.minute)
+# Frames, in order - each 3-hourly field is loaded only once
+frames = load_3hr_sequence(
+    "target",
+    cftime.datetime(
+        args.year, args.month, args.day, args.hour, args.minute, calendar="360_day"
+    ),
+    max(args.nframes, 1),  # The first field sets up the plot, even with no frames
+    args.step,
+)
+dte, target = next(frames)
 
 mask = get_land_mask()
 
@@ -95,7 +119,7 @@ ax_target.imshow(
     origin="lower",
     aspect="auto",
 )
-ax_target.imshow(
+target_img = ax_target.imshow(
     target.data,
     extent=[lons.min(), lons.max(), lats.min(), lats.max()],
     cmap=cmocean.cm.rain,
@@ -109,10 +133,10 @@ ax_target.imshow(
 
 
 # Label with the date
-ax.text(
+date_label = ax.text(
     0.985,
     0.97,
-    "%04d-%02d-%02d:%02d" % (args.year, args.month, args.day, args.hour),
+    "",
     horizontalalignment="right",
     verticalalignment="top",
     color="black",
@@ -124,15 +148,25 @@ ax.text(
     zorder=500,
 )
 
-# Render the figure as a png
-opfile = "%s/%04d%02d%02d%02d%02d.png" % (
-    args.opdir,
-    args.year,
-    args.month,
-    args.day,
-    args.hour,
-    args.minute,
-)
-if args.debug:
-    opfile = "debug.png"
-fig.savefig(opfile)
+# Make each frame - the figure is kept, and only the data in the
+#  target image (and the date label) are replaced.
+for frame in range(args.nframes):
+    if frame > 0:
+        dte, target = next(frames)
+        target_img.set_data(target.data)
+    date_label.set_text(
+        "%04d-%02d-%02d:%02d" % (dte.year, dte.month, dte.day, dte.hour)
+    )
+
+    # Render the figure as a png
+    opfile = "%s/%04d%02d%02d%02d%02d.png" % (
+        args.opdir,
+        dte.year,
+        dte.month,
+        dte.day,
+        dte.hour,
+        dte.minute,
+    )
+    if args.debug:
+        opfile = "debug.png"
+    fig.savefig(opfile)
@@ -15,11 +15,14 @@ import matplotlib
 from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
 from matplotlib.figure import Figure
 from matplotlib.patches import Rectangle
-from matplotlib.lines import Line2D
+from visualizations.utils.graticule import graticule
+from visualizations.utils.background import flatten_background
+from visualizations.utils.regrid import regrid
+from visualizations.utils.quantile_map import QuantileMap, quantile_levels
+from visualizations.utils.wind_field import wind_field, lic_field
+from visualizations.utils.wind_particles import WindParticles
 import cmocean
 
-from pandas import qcut
-
 # Fix dask SPICE bug
 import dask
 
@@ -76,6 +79,54 @@ parser.add_argument(
     type=str,
     required=False,
 )
+parser.add_argument(
+    "--nframes",
+    help="Number of frames to make (all in this one process)",
+    default=1,
+    type=int,
+    required=False,
+)
+parser.add_argument(
+    "--step",
+    help="Time between frames (hours)",
+    default=1,
+    type=float,
+    required=False,
+)
+parser.add_argument(
+    "--precip_table",
+    help="Quantile table for precip (JSON file, or name of a default table)",
+    default="precip",
+    type=str,
+    required=False,
+)
+parser.add_argument(
+    "--float32",
+    help="Keep fields in float32 (less memory, slightly different rounding)",
+    action="store_true",
+)
+parser.add_argument(
+    "--noise_engine",
+    help="How to make the wind noise: 'scatter' (move the noise along the wind), 'lic' (trace back along the wind), or 'particles' (keep the particles from frame to frame)",
+    default="scatter",
+    choices=["scatter", "lic", "particles"],
+    type=str,
+    required=False,
+)
+parser.add_argument(
+    "--noise_threads",
+    help="Threads for the 'lic' noise engine (default all available CPUs)",
+    default=None,
+    type=int,
+    required=False,
+)
+parser.add_argument(
+    "--particle_dir",
+    help="Directory for the 'particles' noise engine checkpoint files",
+    default="%s/AnimH/wind_particles/ERA+SyCLoPS" % os.getenv("SCRATCH"),
+    type=str,
+    required=False,
+)
 parser.add_argument(
     "--debug",
     action="store_true",
@@ -85,34 +136,33 @@ args = parser.parse_args()
 if not os.path.isdir(args.opdir):
     os.makedirs(args.opdir)
 
+# Data type for the plot grids and noise fields
+float_type = np.float64
+if args.float32:
+    float_type = np.float32
+
 
-dte = datetime.datetime(
+# With --float32, convert a cube's data to float32
+#  (otherwise leave it as it is)
+def set_precision(cube):
+    if args.float32 and cube.dtype != np.float32:
+        return cube.copy(data=cube.data.astype(np.float32))
+    return cube
+
+
+start_dte = datetime.datetime(
     args.year, args.month, args.day, int(args.hour), int(args.hour % 1 * 60)
 )
 
 
 # Remap the precipitation to standardise the distribution
 # Normalise a precip field to fixed quantiles
+precip_map = QuantileMap.from_file(args.precip_table)
+
+
 def normalise_precip(p):
-    res = p.copy()
-    res.data[res.data <= 6.68e-5] = 0.79
-    res.data[res.data < 7.77e-5] = 0.81
-    res.data[res.data < 9.25e-5] = 0.83
-    res.data[res.data < 1.11e-4] = 0.85
-    res.data[res.data < 1.35e-4] = 0.87
-    res.data[res.data < 1.68e-4] = 0.89
-    res.data[res.data < 2.16e-4] = 0.91
-    res.data[res.data < 2.94e-4] = 0.93
-    res.data[res.data < 4.30e-4] = 0.95
-    res.data[res.data < 7.11e-4] = 0.97
-    res.data[res.data < 0.1] = 0.99
-    return res
-
-
-u10m = load("10m_u_component_of_wind", dte.year, dte.month, dte.day, dte.hour)
-v10m = load("10m_v_component_of_wind", dte.year, dte.month, dte.day, dte.hour)
-precip = load("total_precipitation", dte.year, dte.month, dte.day, dte.hour)
-precip = normalise_precip(precip)
+    return p.copy(data=precip_map(p.data))
+
 
 mask = get_land_mask()
 
@@ -147,93 +197,13 @@ def plot_cube(resolution, xmin, xmax, ymin, ymax):
     longitude = iris.coords.DimCoord(
         lon_values, standard_name="longitude", units="degrees_east", coord_system=cs
     )
-    dummy_data = np.zeros((len(lat_values), len(lon_values)))
+    dummy_data = np.zeros((len(lat_values), len(lon_values)), dtype=float_type)
     plot_cube = iris.cube.Cube(
         dummy_data, dim_coords_and_dims=[(latitude, 0), (longitude, 1)]
     )
     return plot_cube
 
 
-# Make the wind noise
-def wind_field(uw, vw, zf, sequence=None, iterations=50, epsilon=0.003, sscale=1):
-    # Random field as the source of the distortions
-    z = pickle.load(open(zf, "rb"))
-    z = z.regrid(uw, iris.analysis.Linear())
-    (width, height) = z.data.shape
-    # Each point in this field has an index location (i,j)
-    #  and a real (x,y) position
-    xmin = np.min(uw.coords()[0].points)
-    xmax = np.max(uw.coords()[0].points)
-    ymin = np.min(uw.coords()[1].points)
-    ymax = np.max(uw.coords()[1].points)
-
-    # Convert between index and real positions
-    def i_to_x(i):
-        return xmin + (i / width) * (xmax - xmin)
-
-    def j_to_y(j):
-        return ymin + (j / height) * (ymax - ymin)
-
-    def x_to_i(x):
-        return np.minimum(
-            width - 1,
-            np.maximum(0, np.floor((x - xmin) / (xmax - xmin) * (width - 1))),
-        ).astype(int)
-
-    def y_to_j(y):
-        return np.minimum(
-            height - 1,
-            np.maximum(0, np.floor((y - ymin) / (ymax - ymin) * (height - 1))),
-        ).astype(int)
-
-    i, j = np.mgrid[0:width, 0:height]
-    x = i_to_x(i)
-    y = j_to_y(j)
-    # Result is a distorted version of the random field
-    result = z.copy()
-    # Repeatedly, move the x,y points according to the vector field
-    #  and update result with the random field at their locations
-    ss = uw.copy()
-    ss.data = np.sqrt(uw.data**2 + vw.data**2)
-    if sequence is not None:
-        startsi = np.arange(0, iterations, 3)
-        endpoints = np.tile(startsi, 1 + (width * height) // len(startsi))
-        endpoints += sequence % iterations
-        endpoints[endpoints >= iterations] -= iterations
-        startpoints = endpoints - 25
-        startpoints[startpoints < 0] += iterations
-        endpoints = endpoints[0 : (width * height)].reshape(width, height)
-        startpoints = startpoints[0 : (width * height)].reshape(width, height)
-    else:
-        endpoints = iterations + 1
-        startpoints = -1
-    for k in range(iterations):
-        x += epsilon * vw.data[i, j]
-        x[x > xmax] = xmax
-        x[x < xmin] = xmin
-        y += epsilon * uw.data[i, j]
-        y[y > ymax] = y[y > ymax] - ymax + ymin
-        y[y < ymin] = y[y < ymin] - ymin + ymax
-        i = x_to_i(x)
-        j = y_to_j(y)
-        update = z.data * ss.data / sscale
-        update[(endpoints > startpoints) & ((k > endpoints) | (k < startpoints))] = 0
-        update[(startpoints > endpoints) & ((k > endpoints) & (k < startpoints))] = 0
-        result.data[i, j] += update
-    return result
-
-
-wind_pc = plot_cube(
-    0.2, -180 / args.zoom, 180 / args.zoom, -90 / args.zoom, 90 / args.zoom
-)
-rw = iris.analysis.cartography.rotate_winds(u10m, v10m, cs)
-u10m = rw[0].regrid(wind_pc, iris.analysis.Linear())
-v10m = rw[1].regrid(wind_pc, iris.analysis.Linear())
-seq = (dte - datetime.datetime(2000, 1, 1)).total_seconds() / 3600
-wind_noise_field = wind_field(
-    u10m, v10m, args.zfile, sequence=int(seq * 5), epsilon=0.01
-)
-
 # Define an axes to contain the plot. In this case our axes covers
 #  the whole figure
 ax = fig.add_axes([0, 0, 1, 1])
@@ -251,59 +221,32 @@ ax.set_aspect("auto")
 ax.add_patch(Rectangle((0, 0), 1, 1, facecolor=(0.6, 0.6, 0.6, 1), fill=True, zorder=1))
 
 # Draw lines of latitude and longitude
-for lat in range(-90, 95, 5):
-    lwd = 0.75
-    x = []
-    y = []
-    for lon in range(-180, 181, 1):
-        rp = iris.analysis.cartography.rotate_pole(
-            np.array(lon), np.array(lat), args.pole_longitude, args.pole_latitude
-        )
-        nx = rp[0] + args.npg_longitude
-        if nx > 180:
-            nx -= 360
-        ny = rp[1]
-        if len(x) == 0 or (abs(nx - x[-1]) < 10 and abs(ny - y[-1]) < 10):
-            x.append(nx)
-            y.append(ny)
-        else:
-            ax.add_line(
-                Line2D(x, y, linewidth=lwd, color=(0.4, 0.4, 0.4, 1), zorder=10)
-            )
-            x = []
-            y = []
-    if len(x) > 1:
-        ax.add_line(Line2D(x, y, linewidth=lwd, color=(0.4, 0.4, 0.4, 1), zorder=10))
-
-for lon in range(-180, 185, 5):
-    lwd = 0.75
-    x = []
-    y = []
-    for lat in range(-90, 90, 1):
-        rp = iris.analysis.cartography.rotate_pole(
-            np.array(lon), np.array(lat), args.pole_longitude, args.pole_latitude
-        )
-        nx = rp[0] + args.npg_longitude
-        if nx > 180:
-            nx -= 360
-        ny = rp[1]
-        if len(x) == 0 or (abs(nx - x[-1]) < 10 and abs(ny - y[-1]) < 10):
-            x.append(nx)
-            y.append(ny)
-        else:
-            ax.add_line(
-                Line2D(x, y, linewidth=lwd, color=(0.4, 0.4, 0.4, 1), zorder=10)
-            )
-            x = []
-            y = []
-    if len(x) > 1:
-        ax.add_line(Line2D(x, y, linewidth=lwd, color=(0.4, 0.4, 0.4, 1), zorder=10))
+ax.add_collection(
+    graticule(
+        args.pole_latitude,
+        args.pole_longitude,
+        args.npg_longitude,
+        args.zoom,
+        linewidth=0.75,
+        color=(0.4, 0.4, 0.4, 1),
+        zorder=10,
+    ),
+    autolim=False,
+)
 
 # Plot the land mask
 mask_pc = plot_cube(
     0.05, -180 / args.zoom, 180 / args.zoom, -90 / args.zoom, 90 / args.zoom
 )
-mask = mask.regrid(mask_pc, iris.analysis.Linear())
+mask = regrid(mask, mask_pc)
+# Only land or sea is shown, so with --float32 the mask is kept as bytes
+if args.float32:
+    mask = mask.copy(
+        data=np.ma.MaskedArray(
+            (mask.data.data >= 0.5).astype(np.uint8),
+            mask=np.ma.getmaskarray(mask.data),
+        )
+    )
 lats = mask.coord("latitude").points
 lons = mask.coord("longitude").points
 ax.imshow(
@@ -318,61 +261,56 @@ ax.imshow(
     aspect="auto",
 )
 
+# The background, graticule and land mask don't change - render them once,
+#  as an image that each frame is drawn on top of.
+flatten_background(fig, ax)
 
-# Plot the Wind
+
+# Grids for the dynamic layers - the same for every frame
 wind_pc = plot_cube(
-    0.05, -180 / args.zoom, 180 / args.zoom, -90 / args.zoom, 90 / args.zoom
-)
-wscale = 200
-s = wind_noise_field.data.shape
-wind_noise_field.data = (
-    qcut(
-        wind_noise_field.data.flatten(), wscale, labels=False, duplicates="drop"
-    ).reshape(s)
-    - (wscale - 1) / 2
+    0.2, -180 / args.zoom, 180 / args.zoom, -90 / args.zoom, 90 / args.zoom
 )
-
-# Plot as a colour map
-wnf = wind_noise_field.regrid(wind_pc, iris.analysis.Linear())
-t2m_img = ax.imshow(
-    wnf.data,
-    extent=[lons.min(), lons.max(), lats.min(), lats.max()],
-    cmap=cmocean.cm.gray,
-    alpha=0.6,
-    zorder=100,
-    vmin=-150,
-    vmax=150,
-    origin="lower",
-    aspect="auto",
+wind_plot_pc = plot_cube(
+    0.05, -180 / args.zoom, 180 / args.zoom, -90 / args.zoom, 90 / args.zoom
 )
-
-# Plot the precip
 precip_pc = plot_cube(
     0.25, -180 / args.zoom, 180 / args.zoom, -90 / args.zoom, 90 / args.zoom
 )
-precip = precip.regrid(precip_pc, iris.analysis.Linear())
-wnf = wind_noise_field.regrid(precip, iris.analysis.Linear())
-precip.data[precip.data > 0.8] += wnf.data[precip.data > 0.8] / 3000
-precip.data[precip.data < 0.8] = 0.8
+
+# Random field as the source of the wind distortions - also the same for every frame
+z = pickle.load(open(args.zfile, "rb"))
+z = set_precision(regrid(z, wind_pc))
+
+
+# With the 'particles' noise engine, the particles carry on from frame to
+#  frame - and from the end of the previous run of frames, if there's a
+#  checkpoint for the time just before this run starts. The checkpoints are
+#  kept separately for each noise field and grid (projection and zoom).
+def particle_file(dte):
+    return "%s/%s/%04d%02d%02d%02d%02d.npz" % (
+        args.particle_dir,
+        particles.key,
+        dte.year,
+        dte.month,
+        dte.day,
+        dte.hour,
+        dte.minute,
+    )
+
+
+if args.noise_engine == "particles":
+    particles = WindParticles(z, epsilon=0.01)
+    particles.load(particle_file(start_dte - datetime.timedelta(hours=args.step)))
+
 cols = []
 for ci in range(100):
     cols.append([0.0, 0.3, 0.0, ci / 100])
-precip_img = ax.imshow(
-    precip.data,
-    extent=[lons.min(), lons.max(), lats.min(), lats.max()],
-    cmap=matplotlib.colors.ListedColormap(cols),
-    alpha=0.7,
-    zorder=200,
-    origin="lower",
-    aspect="auto",
-)
-
 
 # Label with the date
-ax.text(
+date_label = ax.text(
     180 / args.zoom - (360 / args.zoom) * 0.009,
     90 / args.zoom - (180 / args.zoom) * 0.016,
-    "%04d-%02d-%02d" % (args.year, args.month, args.day),
+    "",
     horizontalalignment="right",
     verticalalignment="top",
     color="black",
@@ -388,37 +326,46 @@ ax.text(
 from get_data.SyCLoPS.SyCLoPS_load import (
     load_tracks,
     rotate_pole,
-    interpolate_track,
-    make_trail,
-    last_date,
-    first_date,
+    HourlyTrails,
+    TrackIndex,
+    to_seconds,
 )
+from visualizations.utils.tracks import TrackArtists
 
-# Load the tracks for the date
+# Load the tracks
 tracks = load_tracks()
 # Rotate the pole
 tracks = rotate_pole(
     tracks, args.pole_longitude, args.pole_latitude, args.npg_longitude
 )
+
+
+# Index of the track lifetimes, to find the tracks near each frame time
+index = TrackIndex(tracks.store, margin=datetime.timedelta(hours=12))
+# Hourly positions along each track, for drawing the trails
+trails = HourlyTrails(tracks.store)
+
+
 # Reduce the tracks to the date
-itracks = {}
-itracks_before = {}
-itracks_after = {}
-for tid, track in tracks.items():
-    last_dte = last_date(track) - datetime.timedelta(minutes=1)
-    first_dte = first_date(track)
-    itr = interpolate_track(track, dte)
-    if itr is not None:
-        itracks[tid] = itr
-    else:
-        if last_dte < dte and last_dte > dte - datetime.timedelta(hours=12):
-            itr_b = interpolate_track(track, last_dte)
-            itr_b["time_offset"] = dte - last_dte
-            itracks_before[tid] = itr_b
-        if first_dte > dte and first_dte < dte + datetime.timedelta(hours=12):
-            itr_a = interpolate_track(track, first_dte)
-            itr_a["time_offset"] = first_dte - dte
-            itracks_after[tid] = itr_a
+def tracks_at(dte):
+    itracks = {}
+    itracks_before = {}
+    itracks_after = {}
+    active, ended, starting = index.query(dte)
+    store = tracks.store
+    # Interpolate each group of tracks in one go
+    for itr in store.points(store.interpolate(active, to_seconds(dte))):
+        itracks[itr["TID"]] = itr
+    # Ended tracks are shown at 1 minute before their end
+    last_dte = index.end[ended] - 60
+    for itr in store.points(store.interpolate(ended, last_dte)):
+        itr["time_offset"] = dte - itr["datetime"]
+        itracks_before[itr["TID"]] = itr
+    first_dte = index.start[starting]
+    for itr in store.points(store.interpolate(starting, first_dte)):
+        itr["time_offset"] = itr["datetime"] - dte
+        itracks_after[itr["TID"]] = itr
+    return itracks, itracks_before, itracks_after
 
 
 def pointsize(ws):  # Convert wind speed to point size
@@ -429,58 +376,135 @@ def linewidth(ws):  # Convert wind speed to line width
     return (np.sqrt(ws) / 2.0) * 2
 
 
-def plot_object(ax, track, tid, alpha=1):
+def plot_object(objects, track, tid, dte, alpha=1):
     color = "red"
-    ax.add_patch(
-        matplotlib.patches.Circle(
-            (track["LON"], track["LAT"]),
-            radius=pointsize(track["WS"]),
-            facecolor=color,
-            edgecolor=color,
-            linewidth=0.0,
-            alpha=alpha,
-            zorder=580,
-        )
+    objects.add_marker(
+        track["LON"], track["LAT"], pointsize(track["WS"]), color, alpha=alpha
     )
     # Add the trails
-    trail = make_trail(tracks, tid, dte)
-    for i in range(len(trail) - 1):
-        color = "red"
-        if abs(trail[i]["LON"] - trail[i + 1]["LON"]) > 90:
-            continue  # Skip lines that cross the 180th meridian
-        ax.add_line(
-            Line2D(
-                [trail[i]["LON"], trail[i + 1]["LON"]],
-                [trail[i]["LAT"], trail[i + 1]["LAT"]],
-                linewidth=linewidth(trail[i]["WS"]),
-                color=color,
-                alpha=alpha * 0.5,
-                zorder=550,
-            )
-        )
-
+    trail = trails.trail(tracks.store.tid_index[tid], dte)
+    objects.add_trail(
+        trail["LON"], trail["LAT"], linewidth(trail["WS"]), color, alpha=alpha * 0.5
+    )
 
-# Plot the objects
-for tid, track in itracks.items():
-    plot_object(ax, track, tid, alpha=1.0)
 
-for tid, track in itracks_before.items():
-    alpha = 1.0 - track["time_offset"].total_seconds() / 43200.0
-    plot_object(ax, track, tid, alpha=alpha)
-for tid, track in itracks_after.items():
-    alpha = 1.0 - track["time_offset"].total_seconds() / 43200.0
-    plot_object(ax, track, tid, alpha=alpha)
+# Make each frame - the figure and background image are kept,
+#  the data in the wind and precip images is replaced,
+#  and the cyclone objects are redrawn.
+wind_img = None
+precip_img = None
+track_artists = []
+for frame in range(args.nframes):
+    dte = start_dte + datetime.timedelta(hours=frame * args.step)
 
+    u10m = set_precision(
+        load("10m_u_component_of_wind", dte.year, dte.month, dte.day, dte.hour)
+    )
+    v10m = set_precision(
+        load("10m_v_component_of_wind", dte.year, dte.month, dte.day, dte.hour)
+    )
+    precip = set_precision(
+        load("total_precipitation", dte.year, dte.month, dte.day, dte.hour)
+    )
+    precip = normalise_precip(precip)
+
+    rw = iris.analysis.cartography.rotate_winds(u10m, v10m, cs)
+    u10m = regrid(rw[0], wind_pc)
+    v10m = regrid(rw[1], wind_pc)
+    seq = (dte - datetime.datetime(2000, 1, 1)).total_seconds() / 3600
+    if args.noise_engine == "lic":
+        wind_noise_field = lic_field(
+            u10m,
+            v10m,
+            z,
+            sequence=int(seq * 5),
+            epsilon=0.01,
+            threads=args.noise_threads,
+        )
+    elif args.noise_engine == "particles":
+        particles.move_to(u10m, v10m, dte)
+        wind_noise_field = particles.field()
+    else:
+        wind_noise_field = wind_field(
+            u10m, v10m, z, sequence=int(seq * 5), epsilon=0.01
+        )
 
-# Render the figure as a png
-opfile = "%s/%04d%02d%02d%02d%02d.png" % (
-    args.opdir,
-    args.year,
-    args.month,
-    args.day,
-    int(args.hour),
-    int(args.hour % 1 * 60),
-)
-if args.debug:
-    opfile = "debug.png"
-fig.savefig(opfile)
+    # Plot the Wind
+    wscale = 200
+    wind_noise_field.data = (
+        quantile_levels(wind_noise_field.data, wscale) - (wscale - 1) / 2
+    ).astype(float_type)
+
+    # Plot as a colour map
+    wnf = regrid(wind_noise_field, wind_plot_pc)
+    if wind_img is None:
+        wind_img = ax.imshow(
+            wnf.data,
+            extent=[lons.min(), lons.max(), lats.min(), lats.max()],
+            cmap=cmocean.cm.gray,
+            alpha=0.6,
+            zorder=100,
+            vmin=-150,
+            vmax=150,
+            origin="lower",
+            aspect="auto",
+        )
+    else:
+        wind_img.set_data(wnf.data)
+
+    # Plot the precip
+    precip = regrid(precip, precip_pc)
+    wnf = regrid(wind_noise_field, precip)
+    precip.data[precip.data > 0.8] += wnf.data[precip.data > 0.8] / 3000
+    precip.data[precip.data < 0.8] = 0.8
+    if precip_img is None:
+        precip_img = ax.imshow(
+            precip.data,
+            extent=[lons.min(), lons.max(), lats.min(), lats.max()],
+            cmap=matplotlib.colors.ListedColormap(cols),
+            alpha=0.7,
+            zorder=200,
+            origin="lower",
+            aspect="auto",
+        )
+    else:
+        precip_img.set_data(precip.data)
+        precip_img.autoscale()
+
+    date_label.set_text("%04d-%02d-%02d" % (dte.year, dte.month, dte.day))
+
+    for artist in track_artists:
+        artist.remove()
+
+    # Plot the objects
+    objects = TrackArtists()
+    itracks, itracks_before, itracks_after = tracks_at(dte)
+    for tid, track in itracks.items():
+        plot_object(objects, track, tid, dte, alpha=1.0)
+
+    for tid, track in itracks_before.items():
+        alpha = 1.0 - track["time_offset"].total_seconds() / 43200.0
+        plot_object(objects, track, tid, dte, alpha=alpha)
+    for tid, track in itracks_after.items():
+        alpha = 1.0 - track["time_offset"].total_seconds() / 43200.0
+        plot_object(objects, track, tid, dte, alpha=alpha)
+    track_artists = objects.draw(ax, marker_zorder=580, line_zorder=550)
+    trails.forget_unused()
+
+    # Render the figure as a png
+    opfile = "%s/%04d%02d%02d%02d%02d.png" % (
+        args.opdir,
+        dte.year,
+        dte.month,
+        dte.day,
+        dte.hour,
+        dte.minute,
+    )
+    if args.debug:
+        opfile = "debug.png"
+    fig.savefig(opfile)
+
+# Save the particles, for the next run of frames to start from
+#  (if any frames were drawn - the state is at the time of the last one)
+if args.noise_engine == "particles" and args.nframes > 0 and not args.debug:
+    particles.save(particle_file(particles.time))
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+# Accumulate a histogram of all the hourly values of an ERA5 variable
+#  in one month - one job for make_quantile_table.py
+#  (the histograms for each month are merged to make the table).
+
+import os
+import datetime
+import numpy as np
+from get_data.ERA5_hourly.ERA5_hourly import load
+from visualizations.utils.quantile_map import Histogram
+
+import argparse
+
+# Histogram range and scaling (vmin, vmax, log) for each variable
+default_bins = {
+    "2m_temperature": (170.0, 340.0, False),
+    "total_precipitation": (1.0e-8, 1.0, True),
+    "10m_u_component_of_wind": (-80.0, 80.0, False),
+    "10m_v_component_of_wind": (-80.0, 80.0, False),
+    "mean_sea_level_pressure": (85000.0, 110000.0, False),
+}
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--variable", help="Variable name", type=str, required=True)
+parser.add_argument("--year", help="Year", type=int, required=True)
+parser.add_argument("--month", help="Integer month", type=int, required=True)
+parser.add_argument(
+    "--step", help="Use every n'th hour", type=int, default=1, required=False
+)
+parser.add_argument(
+    "--region",
+    help="Only use points in this region (west east south north)",
+    type=float,
+    nargs=4,
+    default=None,
+    required=False,
+)
+parser.add_argument(
+    "--vmin", help="Bottom of histogram range", type=float, default=None, required=False
+)
+parser.add_argument(
+    "--vmax", help="Top of histogram range", type=float, default=None, required=False
+)
+parser.add_argument(
+    "--log", help="Histogram bins evenly spaced in log(value)", action="store_true"
+)
+parser.add_argument(
+    "--nbins", help="Number of histogram bins", type=int, default=10000, required=False
+)
+parser.add_argument(
+    "--name",
+    help="Name for this set of histograms (default is the variable name)",
+    default=None,
+    type=str,
+    required=False,
+)
+args = parser.parse_args()
+if args.name is None:
+    args.name = args.variable
+opfile = "%s/AnimH/quantiles/%s/%04d%02d.npz" % (
+    os.getenv("SCRATCH"),
+    args.name,
+    args.year,
+    args.month,
+)
+if not os.path.isdir(os.path.dirname(opfile)):
+    os.makedirs(os.path.dirname(opfile), exist_ok=True)
+
+if args.vmin is None or args.vmax is None:
+    if args.variable not in default_bins:
+        raise Exception("No default histogram range for %s" % args.variable)
+    args.vmin, args.vmax, args.log = default_bins[args.variable]
+
+histogram = Histogram(args.vmin, args.vmax, nbins=args.nbins, log=args.log)
+
+# Only one hour is in memory at a time
+selected = None
+current = datetime.datetime(args.year, args.month, 1)
+while current.month == args.month:
+    field = load(args.variable, current.year, current.month, current.day, current.hour)
+    if args.region is not None and selected is None:
+        lons = field.coord("longitude").points
+        lats = field.coord("latitude").points
+        west, east, south, north = args.region
+        if west <= east:
+            in_lon = (lons >= west) & (lons <= east)
+        else:  # Region crosses the longitude seam
+            in_lon = (lons >= west) | (lons <= east)
+        in_lat = (lats >= south) & (lats <= north)
+        selected = np.ix_(in_lat, in_lon)
+    if selected is not None:
+        histogram.add(field.data[selected])
+    else:
+        histogram.add(field.data)
+    current += datetime.timedelta(hours=args.step)
+
+# Write to a temporary file, and rename when complete, so a partial
+#  histogram is never merged into a table.
+histogram.save("%s.tmp.npz" % opfile[:-4])
+os.replace("%s.tmp.npz" % opfile[:-4], opfile)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+# Make a quantile table (for visualizations/utils/quantile_map.py) for
+#  an ERA5 variable over a period.
+
+# The data are summarised one month at a time, as histograms (which take
+#  a fixed amount of memory, however much data goes into them), by
+#  accumulate_quantiles.py. If any months are missing, this script writes
+#  the jobs to make them to run.txt - run those (in parallel) and then
+#  run this script again to merge the histograms and make the table.
+
+import os
+import sys
+import numpy as np
+from visualizations.utils.quantile_map import QuantileMap, Histogram
+
+import argparse
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--variable", help="Variable name", type=str, required=True)
+parser.add_argument("--startyear", help="First year", type=int, required=True)
+parser.add_argument("--endyear", help="Last year", type=int, required=True)
+parser.add_argument(
+    "--startmonth",
+    help="First month (of first year)",
+    type=int,
+    default=1,
+    required=False,
+)
+parser.add_argument(
+    "--endmonth", help="Last month (of last year)", type=int, default=12, required=False
+)
+parser.add_argument(
+    "--levels",
+    help="Quantiles to use as bin edges (start,stop,step)",
+    type=str,
+    required=True,
+)
+parser.add_argument(
+    "--values",
+    help="Value for each bin is the quantile of its upper or lower edge",
+    choices=["upper", "lower"],
+    default="upper",
+    required=False,
+)
+parser.add_argument(
+    "--offset",
+    help="Offset added to the field before it's mapped",
+    type=float,
+    default=0,
+    required=False,
+)
+parser.add_argument(
+    "--name",
+    help="Name for this set of histograms (default is the variable name)",
+    default=None,
+    type=str,
+    required=False,
+)
+parser.add_argument(
+    "--step", help="Use every n'th hour", type=int, default=1, required=False
+)
+parser.add_argument(
+    "--region",
+    help="Only use points in this region (west east south north)",
+    type=float,
+    nargs=4,
+    default=None,
+    required=False,
+)
+parser.add_argument(
+    "--vmin",
+    help="Bottom of histogram range (passed to accumulate_quantiles.py)",
+    type=float,
+    default=None,
+    required=False,
+)
+parser.add_argument(
+    "--vmax",
+    help="Top of histogram range (passed to accumulate_quantiles.py)",
+    type=float,
+    default=None,
+    required=False,
+)
+parser.add_argument(
+    "--log",
+    help="Histogram bins evenly spaced in log(value) (passed to accumulate_quantiles.py)",
+    action="store_true",
+)
+parser.add_argument(
+    "--nbins",
+    help="Number of histogram bins (passed to accumulate_quantiles.py)",
+    type=int,
+    default=10000,
+    required=False,
+)
+parser.add_argument(
+    "--opfile",
+    help="Output (JSON) table file name",
+    default=None,
+    type=str,
+    required=False,
+)
+args = parser.parse_args()
+if args.name is None:
+    args.name = args.variable
+if args.opfile is None:
+    args.opfile = "%s/AnimH/quantiles/%s.json" % (os.getenv("SCRATCH"), args.name)
+
+start, stop, step = (float(x) for x in args.levels.split(","))
+levels = np.round(start + step * np.arange(int(round((stop - start) / step)) + 1), 10)
+if levels[0] <= 0 or levels[-1] >= 1:
+    raise Exception("Quantile levels must be between 0 and 1")
+
+
+def histogram_file(year, month):
+    return "%s/AnimH/quantiles/%s/%04d%02d.npz" % (
+        os.getenv("SCRATCH"),
+        args.name,
+        year,
+        month,
+    )
+
+
+def job(year, month):
+    cmd = "./accumulate_quantiles.py --variable=%s --year=%d --month=%d --name=%s" % (
+        args.variable,
+        year,
+        month,
+        args.name,
+    )
+    if args.step != 1:
+        cmd += " --step=%d" % args.step
+    if args.region is not None:
+        cmd += " --region %g %g %g %g" % tuple(args.region)
+    if args.vmin is not None:
+        cmd += " --vmin=%r" % args.vmin
+    if args.vmax is not None:
+        cmd += " --vmax=%r" % args.vmax
+    if args.log:
+        cmd += " --log"
+    if args.nbins != 10000:
+        cmd += " --nbins=%d" % args.nbins
+    return cmd + "\n"
+
+
+months = [
+    (year, month)
+    for year in range(args.startyear, args.endyear + 1)
+    for month in range(1, 13)
+    if (year, month) >= (args.startyear, args.startmonth)
+    and (year, month) <= (args.endyear, args.endmonth)
+]
+missing = [ym for ym in months if not os.path.isfile(histogram_file(*ym))]
+if len(missing) > 0:
+    with open("run.txt", "w") as f:
+        for ym in missing:
+            f.write(job(*ym))
+    print(
+        "%d months still to do - run the jobs in run.txt, then run this again"
+        % len(missing)
+    )
+    sys.exit(0)
+
+# Merge the monthly histograms
+histogram = Histogram.load(histogram_file(*months[0]))
+for ym in months[1:]:
+    histogram.merge(Histogram.load(histogram_file(*ym)))
+
+edges = histogram.quantiles(levels) + args.offset
+if np.any(np.diff(edges) <= 0):
+    raise Exception(
+        "Some quantiles are the same (%s) - choose fewer or different levels" % edges
+    )
+# Bins between the quantile edges get the quantile of one of their edges,
+#  and the bin off the other end gets one step more.
+if args.values == "upper":
+    values = list(levels) + [levels[-1] + step]
+    upper = [True] * len(edges)
+else:
+    values = [levels[0] - step] + list(levels)
+    upper = [False] * len(edges)
+values = [float(np.round(v, 10)) for v in values]
+QuantileMap(edges, values, upper=upper, offset=args.offset).to_file(args.opfile)
+print("Wrote %s" % args.opfile)
@@ -3,8 +3,9 @@
 # Target and ML reconstructed precip fields
 
 import os
-from get_data.ML_tests.ML_data import load, get_land_mask
+from get_data.ML_tests.ML_data import load_hourly_sequence, get_land_mask
 import datetime
+import cftime
 
 import matplotlib
 from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
@@ -26,6 +27,13 @@ parser.add_argument("--day", help="Day of month", type=int, required=True)
 parser.add_argument(
     "--hour", help="Time of day (0 to 23.99)", type=float, required=True
 )
+parser.add_argument(
+    "--nframes",
+    help="Number of hourly frames to make (all in this one process)",
+    default=1,
+    type=int,
+    required=False,
+)
 
 parser.add_argument(
     "--opdir",
@@ -44,13 +52,27 @@ if not os.path.isdir(args.opdir):
     os.makedirs(args.opdir)
 
 
-dte = datetime.datetime(
-    args.year, args.month, args.day, int(args.hour), int(args.hour % 1 * 60)
+# The ML data use a 360-day calendar
+start_dte = cftime.datetime(
+    args.year,
+    args.month,
+    args.day,
+    int(args.hour),
+    int(args.hour % 1 * 60),
+    calendar="360_day",
 )
 
 
-target = load("target", dte.year, dte.month, dte.day, dte.hour)
-ml = load("unet-mse", dte.year, dte.month, dte.day, dte.hour)
+# Frames, in order - the hourly fields for each day are made in one go
+target_frames = load_hourly_sequence("target", start_dte, max(args.nframes, 1))
+ml_frames = load_hourly_sequence("unet-mse", start_dte, max(args.nframes, 1))
+
+
+def load_frame():
+    return (next(target_frames)[1], next(ml_frames)[1])
+
+
+target, ml = load_frame()
 
 
 mask = get_land_mask()
@@ -102,7 +124,7 @@ ax_target.imshow(
     origin="lower",
     aspect="auto",
 )
-ax_target.imshow(
+target_img = ax_target.imshow(
     target.data,
     extent=[lons.min(), lons.max(), lats.min(), lats.max()],
     cmap=cmocean.cm.rain,
@@ -133,7 +155,7 @@ ax_ML.imshow(
     origin="lower",
     aspect="auto",
 )
-ax_ML.imshow(
+ml_img = ax_ML.imshow(
     ml.data,
     extent=[lons.min(), lons.max(), lats.min(), lats.max()],
     cmap=cmocean.cm.rain,
@@ -147,10 +169,10 @@ ax_ML.imshow(
 
 
 # Label with the date
-ax.text(
+date_label = ax.text(
     0.985,
     0.97,
-    "%04d-%02d-%02d" % (args.year, args.month, args.day),
+    "",
     horizontalalignment="right",
     verticalalignment="top",
     color="black",
@@ -162,15 +184,25 @@ ax.text(
     zorder=500,
 )
 
-# Render the figure as a png
-opfile = "%s/%04d%02d%02d%02d%02d.png" % (
-    args.opdir,
-    args.year,
-    args.month,
-    args.day,
-    int(args.hour),
-    int(args.hour % 1 * 60),
-)
-if args.debug:
-    opfile = "debug.png"
-fig.savefig(opfile)
+# Make each frame - the figure is kept, and only the data in the
+#  target and ML images (and the date label) are replaced.
+for frame in range(args.nframes):
+    dte = start_dte + datetime.timedelta(hours=frame)
+    if frame > 0:
+        target, ml = load_frame()
+        target_img.set_data(target.data)
+        ml_img.set_data(ml.data)
+    date_label.set_text("%04d-%02d-%02d" % (dte.year, dte.month, dte.day))
+
+    # Render the figure as a png
+    opfile = "%s/%04d%02d%02d%02d%02d.png" % (
+        args.opdir,
+        dte.year,
+        dte.month,
+        dte.day,
+        dte.hour,
+        dte.minute,
+    )
+    if args.debug:
+        opfile = "debug.png"
+    fig.savefig(opfile)
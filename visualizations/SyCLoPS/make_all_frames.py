@@ -27,11 +27,35 @@ def is_done(year, month, day, hour):
     return False
 
 
+# Each job makes a run of consecutive frames in one process
+frames_per_job = 24
+
+
+def job(start, nframes):
+    return (
+        "./make_frame.py --year=%d --month=%d "
+        + "--day=%d --hour=%f "
+        + "--pole_latitude=90 --pole_longitude=180 "
+        + "--npg_longitude=0 "
+        + "--zoom=1 "
+        + "--nframes=%d "
+        + "\n"
+    ) % (
+        start.year,
+        start.month,
+        start.day,
+        start.hour + start.minute / 60,
+        nframes,
+    )
+
+
 f = open("run.txt", "w+")
 
 start_day = datetime.datetime(2020, 2, 1, 0)
 end_day = datetime.datetime(2021, 1, 31, 23)
 
+run_start = None
+nframes = 0
 current_day = start_day
 while current_day <= end_day:
     if is_done(
@@ -40,21 +64,19 @@ while current_day <= end_day:
         current_day.day,
         current_day.hour + current_day.minute / 60,
     ):
+        if run_start is not None:
+            f.write(job(run_start, nframes))
+            run_start = None
         current_day = current_day + datetime.timedelta(hours=1)
         continue
-    cmd = (
-        "./make_frame.py --year=%d --month=%d "
-        + "--day=%d --hour=%f "
-        + "--pole_latitude=90 --pole_longitude=180 "
-        + "--npg_longitude=0 "
-        + "--zoom=1 "
-        + "\n"
-    ) % (
-        current_day.year,
-        current_day.month,
-        current_day.day,
-        current_day.hour + current_day.minute / 60,
-    )
-    f.write(cmd)
+    if run_start is None:
+        run_start = current_day
+        nframes = 0
+    nframes += 1
+    if nframes == frames_per_job:
+        f.write(job(run_start, nframes))
+        run_start = None
     current_day = current_day + datetime.timedelta(hours=1)
+if run_start is not None:
+    f.write(job(run_start, nframes))
 f.close()
@@ -15,16 +15,18 @@ import matplotlib
 from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
 from matplotlib.figure import Figure
 from matplotlib.patches import Rectangle
-from matplotlib.lines import Line2D
+from visualizations.utils.graticule import graticule
+from visualizations.utils.background import flatten_background
+from visualizations.utils.regrid import regrid
 
 from get_data.SyCLoPS.SyCLoPS_load import (
     load_tracks,
     rotate_pole,
-    interpolate_track,
-    make_trail,
-    last_date,
-    first_date,
+    HourlyTrails,
+    TrackIndex,
+    to_seconds,
 )
+from visualizations.utils.tracks import TrackArtists
 from get_data.ERA5_hourly.ERA5_hourly import get_land_mask
 
 # Fix dask SPICE bug
@@ -96,6 +98,20 @@ parser.add_argument(
     type=str,
     required=False,
 )
+parser.add_argument(
+    "--nframes",
+    help="Number of frames to make (all in this one process)",
+    default=1,
+    type=int,
+    required=False,
+)
+parser.add_argument(
+    "--step",
+    help="Time between frames (hours)",
+    default=1,
+    type=float,
+    required=False,
+)
 parser.add_argument(
     "--debug",
     help="Plot to debug image?",
@@ -109,38 +125,46 @@ if not os.path.isdir(args.opdir):
     os.makedirs(args.opdir)
 
 
-dte = datetime.datetime(
+start_dte = datetime.datetime(
     args.year, args.month, args.day, int(args.hour), int(args.hour % 1 * 60)
 )
 
-# Load the tracks for the date
+# Load the tracks
 tracks = load_tracks()
 # Rotate the pole
 tracks = rotate_pole(
     tracks, args.pole_longitude, args.pole_latitude, args.npg_longitude
 )
+
+
+# Index of the track lifetimes, to find the tracks near each frame time
+index = TrackIndex(tracks.store, margin=datetime.timedelta(hours=12))
+# Hourly positions along each track, for drawing the trails
+trails = HourlyTrails(tracks.store)
+
+
 # Reduce the tracks to the date
-itracks = {}
-itracks_before = {}
-itracks_after = {}
-for tid, track in tracks.items():
-    last_dte = last_date(track) - datetime.timedelta(minutes=1)
-    first_dte = first_date(track)
-    itr = interpolate_track(track, dte)
-    if itr is not None:
-        itracks[tid] = itr
-    else:
-        if last_dte < dte and last_dte > dte - datetime.timedelta(hours=12):
-            itr_b = interpolate_track(track, last_dte)
-            itr_b["time_offset"] = dte - last_dte
-            itracks_before[tid] = itr_b
-        if first_dte > dte and first_dte < dte + datetime.timedelta(hours=12):
-            itr_a = interpolate_track(track, first_dte)
-            itr_a["time_offset"] = first_dte - dte
-            itracks_after[tid] = itr_a
-
-
-# Find tracks
+def tracks_at(dte):
+    itracks = {}
+    itracks_before = {}
+    itracks_after = {}
+    active, ended, starting = index.query(dte)
+    store = tracks.store
+    # Interpolate each group of tracks in one go
+    for itr in store.points(store.interpolate(active, to_seconds(dte))):
+        itracks[itr["TID"]] = itr
+    # Ended tracks are shown at 1 minute before their end
+    last_dte = index.end[ended] - 60
+    for itr in store.points(store.interpolate(ended, last_dte)):
+        itr["time_offset"] = dte - itr["datetime"]
+        itracks_before[itr["TID"]] = itr
+    first_dte = index.start[starting]
+    for itr in store.points(store.interpolate(starting, first_dte)):
+        itr["time_offset"] = itr["datetime"] - dte
+        itracks_after[itr["TID"]] = itr
+    return itracks, itracks_before, itracks_after
+
+
 mask = get_land_mask()
 
 # Define the figure (page size, background color, resolution, ...
@@ -197,59 +221,24 @@ ax.add_patch(
 )
 
 # Draw lines of latitude and longitude
-for lat in range(-90, 95, 5):
-    lwd = 0.25
-    x = []
-    y = []
-    for lon in range(-180, 181, 1):
-        rp = iris.analysis.cartography.rotate_pole(
-            np.array(lon), np.array(lat), args.pole_longitude, args.pole_latitude
-        )
-        nx = rp[0] + args.npg_longitude
-        if nx > 180:
-            nx -= 360
-        ny = rp[1]
-        if len(x) == 0 or (abs(nx - x[-1]) < 10 and abs(ny - y[-1]) < 10):
-            x.append(nx)
-            y.append(ny)
-        else:
-            ax.add_line(
-                Line2D(x, y, linewidth=lwd, color=(0.4, 0.4, 0.4, 1), zorder=10)
-            )
-            x = []
-            y = []
-    if len(x) > 1:
-        ax.add_line(Line2D(x, y, linewidth=lwd, color=(0.4, 0.4, 0.4, 1), zorder=10))
-
-for lon in range(-180, 185, 5):
-    lwd = 0.25
-    x = []
-    y = []
-    for lat in range(-90, 90, 1):
-        rp = iris.analysis.cartography.rotate_pole(
-            np.array(lon), np.array(lat), args.pole_longitude, args.pole_latitude
-        )
-        nx = rp[0] + args.npg_longitude
-        if nx > 180:
-            nx -= 360
-        ny = rp[1]
-        if len(x) == 0 or (abs(nx - x[-1]) < 10 and abs(ny - y[-1]) < 10):
-            x.append(nx)
-            y.append(ny)
-        else:
-            ax.add_line(
-                Line2D(x, y, linewidth=lwd, color=(0.4, 0.4, 0.4, 1), zorder=10)
-            )
-            x = []
-            y = []
-    if len(x) > 1:
-        ax.add_line(Line2D(x, y, linewidth=lwd, color=(0.4, 0.4, 0.4, 1), zorder=10))
+ax.add_collection(
+    graticule(
+        args.pole_latitude,
+        args.pole_longitude,
+        args.npg_longitude,
+        args.zoom,
+        linewidth=0.25,
+        color=(0.4, 0.4, 0.4, 1),
+        zorder=10,
+    ),
+    autolim=False,
+)
 
 # Plot the land mask
 mask_pc = plot_cube(
     0.05, -180 / args.zoom, 180 / args.zoom, -90 / args.zoom, 90 / args.zoom
 )
-mask = mask.regrid(mask_pc, iris.analysis.Linear())
+mask = regrid(mask, mask_pc)
 lats = mask.coord("latitude").points
 lons = mask.coord("longitude").points
 mask_img = ax.imshow(
@@ -264,6 +253,10 @@ mask_img = ax.imshow(
     aspect="auto",
 )
 
+# The background, graticule and land mask don't change - render them once,
+#  as an image that each frame is drawn on top of.
+flatten_background(fig, ax)
+
 
 def pointsize(ws):  # Convert wind speed to point size
     return (np.sqrt(ws) / 5.0) * 2
@@ -273,61 +266,28 @@ def linewidth(ws):  # Convert wind speed to line width
     return (np.sqrt(ws) / 2.0) * 2
 
 
-def plot_object(ax, track, tid, alpha=1):
+def plot_object(objects, track, tid, dte, alpha=1):
     #    color = (1.0 * track["Tropical_Flag"], 0, 1.0 - track["Tropical_Flag"], 1)
-    try:
-        color = colors[track["Short_Label"]]
-    except KeyError:
-        color = "black"
-    ax.add_patch(
-        matplotlib.patches.Circle(
-            (track["LON"], track["LAT"]),
-            radius=pointsize(track["WS"]),
-            facecolor=color,
-            edgecolor=color,
-            linewidth=0.0,
-            alpha=alpha,
-            zorder=180,
-        )
+    color = colors.get(track["Short_Label"], "black")
+    objects.add_marker(
+        track["LON"], track["LAT"], pointsize(track["WS"]), color, alpha=alpha
     )
     # Add the trails
-    trail = make_trail(tracks, tid, dte)
-    for i in range(len(trail) - 1):
-        #        color = (1.0 * trail[i]["Tropical_Flag"], 0, 1.0 - trail[i]["Tropical_Flag"], 1)
-        try:
-            color = colors[trail[i]["Short_Label"]]
-        except KeyError:
-            color = "black"
-        if abs(trail[i]["LON"] - trail[i + 1]["LON"]) > 90:
-            continue  # Skip lines that cross the 180th meridian
-        ax.add_line(
-            Line2D(
-                [trail[i]["LON"], trail[i + 1]["LON"]],
-                [trail[i]["LAT"], trail[i + 1]["LAT"]],
-                linewidth=linewidth(trail[i]["WS"]),
-                color=color,
-                alpha=alpha * 0.5,
-                zorder=150,
-            )
-        )
-
-
-# Plot the objects
-for tid, track in itracks.items():
-    plot_object(ax, track, tid, alpha=1.0)
-
-for tid, track in itracks_before.items():
-    alpha = 1.0 - track["time_offset"].total_seconds() / 43200.0
-    plot_object(ax, track, tid, alpha=alpha)
-for tid, track in itracks_after.items():
-    alpha = 1.0 - track["time_offset"].total_seconds() / 43200.0
-    plot_object(ax, track, tid, alpha=alpha)
+    trail = trails.trail(tracks.store.tid_index[tid], dte)
+    objects.add_trail(
+        trail["LON"],
+        trail["LAT"],
+        linewidth(trail["WS"]),
+        [colors.get(label, "black") for label in trail["Short_Label"]],
+        alpha=alpha * 0.5,
+    )
+
 
 # Label with the date
-ax.text(
+date_label = ax.text(
     180 / args.zoom - (360 / args.zoom) * 0.009,
     90 / args.zoom - (180 / args.zoom) * 0.016,
-    "%04d-%02d-%02d" % (args.year, args.month, args.day),
+    "",
     horizontalalignment="right",
     verticalalignment="top",
     color="black",
@@ -339,17 +299,42 @@ ax.text(
     zorder=500,
 )
 
-opfile = "%s/%04d%02d%02d%02d%02d.png" % (
-    args.opdir,
-    args.year,
-    args.month,
-    args.day,
-    int(args.hour),
-    int(args.hour % 1 * 60),
-)
-if args.debug:
-
-    opfile = "debug.png"
+# Make each frame - the figure and background image are kept,
+#  and only the cyclone objects and the date label are replaced.
+track_artists = []
+for frame in range(args.nframes):
+    dte = start_dte + datetime.timedelta(hours=frame * args.step)
+
+    for artist in track_artists:
+        artist.remove()
+
+    # Plot the objects
+    objects = TrackArtists()
+    itracks, itracks_before, itracks_after = tracks_at(dte)
+    for tid, track in itracks.items():
+        plot_object(objects, track, tid, dte, alpha=1.0)
+
+    for tid, track in itracks_before.items():
+        alpha = 1.0 - track["time_offset"].total_seconds() / 43200.0
+        plot_object(objects, track, tid, dte, alpha=alpha)
+    for tid, track in itracks_after.items():
+        alpha = 1.0 - track["time_offset"].total_seconds() / 43200.0
+        plot_object(objects, track, tid, dte, alpha=alpha)
+    track_artists = objects.draw(ax, marker_zorder=180, line_zorder=150)
+    trails.forget_unused()
+
+    date_label.set_text("%04d-%02d-%02d" % (dte.year, dte.month, dte.day))
+
+    opfile = "%s/%04d%02d%02d%02d%02d.png" % (
+        args.opdir,
+        dte.year,
+        dte.month,
+        dte.day,
+        dte.hour,
+        dte.minute,
+    )
+    if args.debug:
+        opfile = "debug.png"
 
-# Render the figure as a png
-fig.savefig(opfile)
+    # Render the figure as a png
+    fig.savefig(opfile)
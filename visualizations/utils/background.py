@@ -0,0 +1,18 @@
+# The background, graticule and land mask are the same in every frame.
+#  Render them once, and replace them with a single image of the result
+#  (at the output resolution), so each frame only has to draw the layers
+#  that change.
+
+import numpy as np
+
+
+# Call this after drawing the static layers, and before adding anything
+#  else to the axes. Returns the image that replaces them.
+def flatten_background(fig, ax):
+    static = list(ax.patches) + list(ax.lines) + list(ax.collections) + list(ax.images)
+    fig.canvas.draw()
+    background = np.array(fig.canvas.buffer_rgba())
+    for artist in static:
+        artist.remove()
+    # Under the axes, so everything drawn later goes on top
+    return fig.figimage(background, xo=0, yo=0, origin="upper", zorder=-1)
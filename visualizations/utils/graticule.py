@@ -0,0 +1,114 @@
+# Lines of latitude and longitude, on a rotated-pole projection.
+
+# All the vertices are rotated in one call, and the lines are split into
+#  pieces where they jump across the edge of the map. The pieces are kept
+#  on disk, so each projection only needs doing once.
+
+import os
+import numpy as np
+import iris.analysis.cartography
+from matplotlib.collections import LineCollection
+
+
+# Split a line wherever it jumps by 10 degrees or more. As in the original
+#  point-by-point version, the point after a jump is dropped, and the one
+#  after that starts a new piece.
+def split_line(x, y):
+    jump = np.zeros(len(x), dtype=bool)
+    jump[1:] = (np.abs(np.diff(x)) >= 10) | (np.abs(np.diff(y)) >= 10)
+    # Within a run of jumps, every other point is dropped (the point after
+    #  a dropped point always starts a new piece).
+    index = np.arange(len(x))
+    last_kept = np.maximum.accumulate(np.where(jump, -1, index))
+    dropped = jump & ((index - last_kept) % 2 == 1)
+    pieces = np.split(np.stack((x, y), axis=-1), np.nonzero(dropped)[0])
+    pieces = [pieces[0]] + [piece[1:] for piece in pieces[1:]]
+    return [piece for piece in pieces if len(piece) > 1]
+
+
+# Rotate a set of lines (one per row of lon and lat) and split them
+def rotated_lines(lon, lat, pole_latitude, pole_longitude, npg_longitude):
+    rp = iris.analysis.cartography.rotate_pole(
+        lon.astype(np.float64), lat.astype(np.float64), pole_longitude, pole_latitude
+    )
+    x = rp[0] + npg_longitude
+    x[x > 180] -= 360
+    pieces = []
+    for line in range(x.shape[0]):
+        pieces += split_line(x[line], rp[1][line])
+    return pieces
+
+
+# Every 5 degrees, with a vertex every degree
+def make_graticule(pole_latitude, pole_longitude, npg_longitude):
+    lat, lon = np.meshgrid(
+        np.arange(-90, 95, 5), np.arange(-180, 181, 1), indexing="ij"
+    )
+    pieces = rotated_lines(lon, lat, pole_latitude, pole_longitude, npg_longitude)
+    lon, lat = np.meshgrid(
+        np.arange(-180, 185, 5), np.arange(-90, 90, 1), indexing="ij"
+    )
+    pieces += rotated_lines(lon, lat, pole_latitude, pole_longitude, npg_longitude)
+    return pieces
+
+
+# Only the pieces that reach into the region plotted at this zoom
+def visible_pieces(pieces, zoom):
+    return [
+        piece
+        for piece in pieces
+        if piece[:, 0].max() >= -180 / zoom
+        and piece[:, 0].min() <= 180 / zoom
+        and piece[:, 1].max() >= -90 / zoom
+        and piece[:, 1].min() <= 90 / zoom
+    ]
+
+
+# Load the pieces from the disk cache, or make them (and cache them).
+#  The cache file is named by the exact (repr) values of the arguments.
+def graticule_pieces(pole_latitude, pole_longitude, npg_longitude, zoom=1):
+    cache_file = "%s/AnimH/graticule/%r_%r_%r_%r.npz" % (
+        os.getenv("SCRATCH"),
+        float(pole_latitude),
+        float(pole_longitude),
+        float(npg_longitude),
+        float(zoom),
+    )
+    if os.path.isfile(cache_file):
+        with np.load(cache_file) as cached:
+            vertices = cached["vertices"]
+            offsets = cached["offsets"]
+        return [vertices[offsets[i] : offsets[i + 1]] for i in range(len(offsets) - 1)]
+    pieces = visible_pieces(
+        make_graticule(pole_latitude, pole_longitude, npg_longitude), zoom
+    )
+    offsets = np.cumsum([0] + [len(piece) for piece in pieces])
+    if len(pieces) > 0:
+        vertices = np.concatenate(pieces)
+    else:  # No lines in the plotted region
+        vertices = np.zeros((0, 2))
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    # Write to a temporary file, and rename when complete, so a concurrent
+    #  run never loads a partial file.
+    np.savez("%s.tmp.npz" % cache_file, vertices=vertices, offsets=offsets)
+    os.replace("%s.tmp.npz" % cache_file, cache_file)
+    return pieces
+
+
+# The graticule as a single LineCollection, ready to add to the axes
+def graticule(
+    pole_latitude,
+    pole_longitude,
+    npg_longitude,
+    zoom=1,
+    linewidth=0.75,
+    color=(0.4, 0.4, 0.4, 1),
+    zorder=10,
+):
+    return LineCollection(
+        graticule_pieces(pole_latitude, pole_longitude, npg_longitude, zoom),
+        linewidths=linewidth,
+        colors=[color],
+        capstyle="projecting",  # Same as Line2D
+        zorder=zorder,
+    )
@@ -0,0 +1,276 @@
+# Map a field onto fixed values, by which of a set of bins each point is in
+
+# Used to quantile-normalise the precip and temperature fields: the bin
+#  edges are quantiles of the field's climatological distribution, and each
+#  bin gets a fixed value, so the plotted distribution is roughly flat.
+#  Each point is classified against the whole table of edges in one go,
+#  rather than with a chain of threshold tests and overwrites.
+
+# The tables are JSON files (default ones are in quantile_tables/):
+#  {
+#   "offset": added to the field before classifying it (optional),
+#   "edges": bin edges (increasing),
+#   "values": value for each bin (one more than the number of edges) -
+#             null to leave points in that bin unchanged,
+#   "upper": for each edge, true if points exactly on it go in the bin
+#            above (optional - default is the bin below)
+#  }
+
+import os
+import json
+import numpy as np
+
+table_dir = "%s/quantile_tables" % os.path.dirname(os.path.abspath(__file__))
+
+
+class QuantileMap:
+    def __init__(self, edges, values, upper=None, offset=0):
+        self.edges = np.asarray(edges, dtype=np.float64)
+        if self.edges.ndim != 1 or np.any(np.diff(self.edges) <= 0):
+            raise Exception("Bin edges must be a strictly increasing list")
+        if len(values) != len(self.edges) + 1:
+            raise Exception(
+                "Need %d bin values, got %d" % (len(self.edges) + 1, len(values))
+            )
+        # Unchanged bins are NaN in the lookup table
+        self.values = np.array(
+            [np.nan if v is None else v for v in values], dtype=np.float64
+        )
+        if upper is None:
+            upper = [False] * len(self.edges)
+        if len(upper) != len(self.edges):
+            raise Exception("Need one 'upper' flag for each bin edge")
+        # Padded, so it can be indexed with the bin number of any point
+        self.upper = np.append(np.asarray(upper, dtype=bool), False)
+        self.offset = offset
+
+    # Load a table from a JSON file - a path, or the name of one of the
+    #  default tables
+    @classmethod
+    def from_file(cls, fname):
+        if not os.path.isfile(fname):
+            fname = "%s/%s.json" % (table_dir, fname)
+        if not os.path.isfile(fname):
+            raise Exception("No quantile table %s" % fname)
+        with open(fname) as f:
+            table = json.load(f)
+        return cls(
+            table["edges"],
+            table["values"],
+            upper=table.get("upper"),
+            offset=table.get("offset", 0),
+        )
+
+    def to_file(self, fname):
+        with open(fname, "w") as f:
+            json.dump(
+                {
+                    "offset": self.offset,
+                    "edges": self.edges.tolist(),
+                    "values": [
+                        None if np.isnan(v) else v for v in self.values.tolist()
+                    ],
+                    "upper": self.upper[:-1].tolist(),
+                },
+                f,
+                indent=1,
+            )
+
+    # Map an array (masked or not). Returns a new array of the same type
+    #  and dtype.
+    def __call__(self, data):
+        x = np.ma.getdata(data)
+        if self.offset != 0:
+            x = x + x.dtype.type(self.offset)
+        # Compare in the data's dtype - except that numpy.ma compares masked
+        #  arrays with Python numbers in float64, and we want the same
+        #  results as a chain of threshold tests on the field would give.
+        dtype = x.dtype
+        if np.ma.isMaskedArray(data):
+            dtype = np.promote_types(dtype, np.float64)
+        edges = self.edges.astype(dtype)
+        # Bin number - number of edges below the point (counting edges
+        #  it's on if they go with the bin above). For small tables one
+        #  comparison per edge is quicker than a binary search.
+        if len(edges) <= 32:
+            bins = np.zeros(x.shape, dtype=np.uint8)
+            below = np.empty(x.shape, dtype=bool)
+            for edge, upper in zip(edges, self.upper):
+                if upper:
+                    np.greater_equal(x, edge, out=below)
+                else:
+                    np.greater(x, edge, out=below)
+                bins += below
+        else:
+            edges[self.upper[:-1]] = np.nextafter(
+                edges[self.upper[:-1]], dtype.type(-np.inf)
+            )
+            bins = np.searchsorted(edges, x, side="left")
+        mapped = self.values.astype(x.dtype)[bins]
+        # Points in unchanged bins (and missing points) keep their values
+        keep = np.isnan(mapped)
+        keep |= np.isnan(x)
+        np.copyto(mapped, x, where=keep)
+        if np.ma.isMaskedArray(data):
+            return np.ma.MaskedArray(mapped, mask=np.ma.getmask(data).copy())
+        return mapped
+
+
+# Histogram of a field's values, to estimate quantiles for the tables.
+#  Fixed bins (evenly spaced in the value, or in its log), so the memory
+#  needed doesn't depend on how much data goes in, and histograms made
+#  separately (from different months, say) can be added together.
+#  Values outside the range are counted in under- and overflow bins.
+class Histogram:
+    def __init__(self, vmin, vmax, nbins=10000, log=False):
+        if vmax <= vmin or (log and vmin <= 0):
+            raise Exception("Bad histogram range %g to %g" % (vmin, vmax))
+        self.vmin = vmin
+        self.vmax = vmax
+        self.nbins = nbins
+        self.log = log
+        self.counts = np.zeros(nbins + 2, dtype=np.int64)
+        # Smallest and largest values seen (for the end bins)
+        self.low = np.inf
+        self.high = -np.inf
+
+    # Bin positions (in the log, if log binning) of values
+    def scale(self, values):
+        if self.log:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                values = np.log(np.where(values > 0, values, np.nan))
+            return (values - np.log(self.vmin)) / (
+                np.log(self.vmax) - np.log(self.vmin)
+            )
+        return (values - self.vmin) / (self.vmax - self.vmin)
+
+    def unscale(self, position):
+        if self.log:
+            return np.exp(
+                np.log(self.vmin) + position * (np.log(self.vmax) - np.log(self.vmin))
+            )
+        return self.vmin + position * (self.vmax - self.vmin)
+
+    # Add the (unmasked, finite) values in an array
+    def add(self, data):
+        values = np.ma.compressed(data).astype(np.float64)
+        values = values[np.isfinite(values)]
+        if values.size == 0:
+            return
+        self.low = min(self.low, values.min())
+        self.high = max(self.high, values.max())
+        position = self.scale(values) * self.nbins
+        # Non-positive values, with log binning, go in the underflow bin
+        position[np.isnan(position)] = -1
+        index = np.floor(np.clip(position, -1, self.nbins)).astype(np.int64) + 1
+        self.counts += np.bincount(index, minlength=self.nbins + 2)
+
+    def merge(self, other):
+        if (self.vmin, self.vmax, self.nbins, self.log) != (
+            other.vmin,
+            other.vmax,
+            other.nbins,
+            other.log,
+        ):
+            raise Exception("Can't merge histograms with different bins")
+        self.counts += other.counts
+        self.low = min(self.low, other.low)
+        self.high = max(self.high, other.high)
+
+    # Estimated values at the given quantiles (0-1), interpolating
+    #  linearly within a bin (and between the extreme values seen and
+    #  the histogram range in the end bins).
+    def quantiles(self, levels):
+        total = self.counts.sum()
+        if total == 0:
+            raise Exception("No data in histogram")
+        cumulative = np.concatenate(([0], np.cumsum(self.counts))) / total
+        # Edges of all the bins, including the under- and overflow bins
+        edges = self.unscale(np.arange(self.nbins + 1) / self.nbins)
+        edges = np.concatenate(
+            ([min(self.low, edges[0])], edges, [max(self.high, edges[-1])])
+        )
+        if self.log:
+            # Everything non-positive is lumped together in the underflow bin
+            edges[0] = min(self.low, 0)
+        result = []
+        for level in levels:
+            i = np.searchsorted(cumulative, level, side="left")
+            i = min(max(i, 1), len(cumulative) - 1)
+            fraction = 0.0
+            if cumulative[i] > cumulative[i - 1]:
+                fraction = (level - cumulative[i - 1]) / (
+                    cumulative[i] - cumulative[i - 1]
+                )
+            result.append(edges[i - 1] + fraction * (edges[i] - edges[i - 1]))
+        return np.array(result)
+
+    def save(self, fname):
+        np.savez(
+            fname,
+            counts=self.counts,
+            bins=np.array([self.vmin, self.vmax, self.nbins, self.log]),
+            extremes=np.array([self.low, self.high]),
+        )
+
+    @classmethod
+    def load(cls, fname):
+        with np.load(fname) as f:
+            vmin, vmax, nbins, log = f["bins"]
+            histogram = cls(vmin, vmax, nbins=int(nbins), log=bool(log))
+            histogram.counts[:] = f["counts"]
+            histogram.low, histogram.high = f["extremes"]
+        return histogram
+
+
+# Quantile level (0 to nlevels-1) of each point in a field - the same as
+#  pandas.qcut(data.flatten(), nlevels, labels=False, duplicates="drop")
+#  (with NaN for missing points), but without the pandas objects, and
+#  quicker: the level edges come from one sort, and most points are
+#  classified with a lookup table on a fine, even grid of values - only
+#  points near a level edge need a binary search.
+def quantile_levels(data, nlevels=200, ncells=65536):
+    x = np.asarray(data, dtype=np.float64).ravel()
+    valid = ~np.isnan(x)
+    if valid.all():
+        ordered = np.sort(x)
+    else:
+        ordered = np.sort(x[valid])
+    # Same quantiles, calculated the same way, as pandas
+    quantiles = np.linspace(0, 1, nlevels + 1)
+    np.putmask(
+        quantiles,
+        nlevels * quantiles != np.arange(nlevels + 1),
+        np.nextafter(quantiles, 1),
+    )
+    edges = np.unique(np.percentile(ordered, quantiles * 100.0))
+
+    # Number of edges below each point. Cell j (1 to ncells) of the
+    #  lookup grid covers lo+(j-1)/scale to lo+j/scale (0 and ncells+1 are
+    #  for points off the ends). A cell is only used directly if there are
+    #  no edges in it or its neighbours (so rounding in finding the cell
+    #  can't matter).
+    count = np.zeros(ncells + 2, dtype=np.intp)
+    clean = np.zeros(ncells + 2, dtype=bool)
+    lo, hi = edges[0], edges[-1]
+    if hi > lo:
+        scale = ncells / (hi - lo)
+        below = np.searchsorted(edges, lo + np.arange(ncells + 1) / scale)
+        j = np.arange(1, ncells + 1)
+        count[1:-1] = below[j - 1]
+        clean[1:-1] = below[np.maximum(j - 2, 0)] == below[np.minimum(j + 1, ncells)]
+        cell = (x - lo) * scale
+        np.clip(cell, -1, ncells, out=cell)
+        cell[~valid] = -1
+        cell = cell.astype(np.intp) + 1
+    else:
+        cell = np.zeros(x.shape, dtype=np.intp)
+    ids = count[cell]
+    search = ~clean[cell]
+    ids[search] = np.searchsorted(edges, x[search], side="left")
+    # The lowest edge is in the first level
+    ids[x == lo] = 1
+
+    result = ids.astype(np.float64) - 1
+    result[~valid | (ids == 0) | (ids == len(edges))] = np.nan
+    return result.reshape(np.shape(data))
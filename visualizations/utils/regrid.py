@@ -0,0 +1,182 @@
+# Linear regridding with precomputed weights
+
+# cube.regrid(target, iris.analysis.Linear()) works out the interpolation
+#  weights from scratch every time it is called. Here the weights for each
+#  (source grid, target grid) pair are worked out once - in the same way
+#  as Iris does it, so the results are the same (to float32 precision, as
+#  the weights are kept as float32, to save memory) - and kept as a sparse
+#  matrix, both in memory and on disk. Regridding a field is then one
+#  sparse matrix-vector product.
+
+import os
+import hashlib
+import numpy as np
+import scipy.sparse
+import iris.cube
+import iris.analysis
+
+
+# The X and Y dimension coordinates of a cube
+def grid_coords(cube):
+    return (
+        cube.coord(axis="X", dim_coords=True),
+        cube.coord(axis="Y", dim_coords=True),
+    )
+
+
+# A name for a (source grid, target grid) pair
+def grid_key(source, target):
+    key = hashlib.sha1()
+    for cube in (source, target):
+        for coord in grid_coords(cube):
+            key.update(coord.points.tobytes())
+            key.update(
+                repr(
+                    (
+                        coord.points.dtype,
+                        coord.circular,
+                        coord.units,
+                        coord.coord_system,
+                    )
+                ).encode()
+            )
+    return key.hexdigest()
+
+
+# Position of each sample point in a (monotonically increasing) grid:
+#  index of the grid point below, and fractional distance to the next one.
+#  Points outside the grid use the end cells (linear extrapolation).
+def find_indices(grid, x):
+    i = np.searchsorted(grid, x) - 1
+    i[i < 0] = 0
+    i[i > grid.size - 2] = grid.size - 2
+    return (i, (x - grid[i]) / (grid[i + 1] - grid[i]))
+
+
+# Weights for linear interpolation from the source grid to the target grid:
+#  four (source index, weight) pairs for each target point. Source indices
+#  are into the flattened (y,x) source array.
+def make_weights(source, target):
+    src_x, src_y = grid_coords(source)
+    tgt_x, tgt_y = grid_coords(target)
+    if src_x.points.size < 2 or src_y.points.size < 2:
+        raise Exception("Source grid must have at least 2 points in X and Y")
+
+    # Target points, in the source coordinate system
+    sample_x, sample_y = np.meshgrid(tgt_x.points, tgt_y.points)
+    if src_x.coord_system != tgt_x.coord_system:
+        xyz = src_x.coord_system.as_cartopy_crs().transform_points(
+            tgt_x.coord_system.as_cartopy_crs(), sample_x, sample_y
+        )
+        sample_x = xyz[..., 0]
+        sample_y = xyz[..., 1]
+    sample_x = sample_x.astype(np.float64).ravel()
+    sample_y = sample_y.astype(np.float64).ravel()
+
+    # Source grid, increasing, and with longitude wrapped round if circular
+    x_points = src_x.points
+    x_index = np.arange(x_points.size)
+    if x_points[0] > x_points[1]:
+        x_points = x_points[::-1]
+        x_index = x_index[::-1]
+    y_points = src_y.points
+    y_index = np.arange(y_points.size)
+    if y_points[0] > y_points[1]:
+        y_points = y_points[::-1]
+        y_index = y_index[::-1]
+    if src_x.circular:
+        modulus = np.array(src_x.units.modulus or 0, dtype=src_x.dtype)
+        x_points = np.append(x_points, x_points[0] + modulus)
+        x_index = np.append(x_index, x_index[0])
+    if src_x.units.modulus:
+        modulus = src_x.units.modulus
+        offset = (x_points.max() + x_points.min() - modulus) * 0.5
+        sample_x = ((sample_x - offset) % modulus) + offset
+
+    i, di = find_indices(x_points, sample_x)
+    j, dj = find_indices(y_points, sample_y)
+    columns = np.empty((sample_x.size, 4), dtype=np.int32)
+    weights = np.empty((sample_x.size, 4), dtype=np.float32)
+    for corner, (ci, wi, cj, wj) in enumerate(
+        (
+            (i, 1 - di, j, 1 - dj),
+            (i, 1 - di, j + 1, dj),
+            (i + 1, di, j, 1 - dj),
+            (i + 1, di, j + 1, dj),
+        )
+    ):
+        columns[:, corner] = y_index[cj] * src_x.points.size + x_index[ci]
+        weights[:, corner] = wi * wj
+    return (columns, weights)
+
+
+class Regridder:
+    def __init__(self, source, target):
+        self.key = grid_key(source, target)
+        self.target = grid_coords(target)
+        self.shape = (self.target[1].points.size, self.target[0].points.size)
+        src_x, src_y = grid_coords(source)
+        n_source = src_x.points.size * src_y.points.size
+        cache_file = "%s/AnimH/regrid/%s.npz" % (os.getenv("SCRATCH"), self.key)
+        if os.path.isfile(cache_file):
+            with np.load(cache_file) as cached:
+                columns = cached["columns"]
+                weights = cached["weights"].astype(np.float32, copy=False)
+        else:
+            columns, weights = make_weights(source, target)
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            # Write to a temporary file, and rename when complete, so
+            #  parallel jobs never load a partial file.
+            np.savez("%s.tmp.npz" % cache_file, columns=columns, weights=weights)
+            os.replace("%s.tmp.npz" % cache_file, cache_file)
+        self.matrix = scipy.sparse.csr_matrix(
+            (
+                weights.ravel(),
+                columns.ravel(),
+                np.arange(0, weights.size + 1, 4),
+            ),
+            shape=(weights.shape[0], n_source),
+        )
+
+    # Regrid a cube on the source grid
+    def __call__(self, cube):
+        dtype = cube.dtype
+        if dtype.kind == "i":
+            dtype = np.promote_types(dtype, np.float16)
+        data = self.matrix @ np.ma.getdata(cube.data).reshape(-1)
+        data = data.astype(dtype).reshape(self.shape)
+        # Points with any contribution from a masked point are masked
+        if np.ma.isMaskedArray(cube.data):
+            mask = np.ma.getmaskarray(cube.data).astype(cube.dtype).reshape(-1)
+            mask = (self.matrix @ mask).reshape(self.shape) > 0
+            data = np.ma.MaskedArray(data, mask=mask)
+        result = iris.cube.Cube(
+            data,
+            dim_coords_and_dims=[
+                (self.target[1].copy(), 0),
+                (self.target[0].copy(), 1),
+            ],
+        )
+        result.metadata = cube.metadata
+        for coord in cube.coords(dim_coords=False):
+            if len(cube.coord_dims(coord)) == 0:
+                result.add_aux_coord(coord.copy())
+        return result
+
+
+# Regridders already made, by grid pair
+regridders = {}
+
+
+# Drop-in replacement for cube.regrid(target, iris.analysis.Linear())
+#  (for 2d (y,x) cubes - anything else goes to Iris)
+def regrid(cube, target):
+    if cube.ndim != 2:
+        return cube.regrid(target, iris.analysis.Linear())
+    x_coord, y_coord = grid_coords(cube)
+    if cube.coord_dims(y_coord) != (0,) or cube.coord_dims(x_coord) != (1,):
+        return cube.regrid(target, iris.analysis.Linear())
+    key = grid_key(cube, target)
+    if key not in regridders:
+        regridders[key] = Regridder(cube, target)
+    return regridders[key](cube)
@@ -0,0 +1,80 @@
+# Draw cyclone objects and their trails as two collections (one for all
+#  the trail segments, and one for all the markers), rather than as an
+#  artist for each segment and each marker.
+
+import numpy as np
+import matplotlib.colors
+from matplotlib.collections import LineCollection, EllipseCollection
+
+
+class TrackArtists:
+    def __init__(self):
+        self.centres = []
+        self.radii = []
+        self.marker_colors = []
+        self.segments = []
+        self.widths = []
+        self.line_colors = []
+
+    # A circle of the given radius (in data units) at (lon,lat)
+    def add_marker(self, lon, lat, radius, color, alpha=1):
+        self.centres.append((lon, lat))
+        self.radii.append(radius)
+        self.marker_colors.append(matplotlib.colors.to_rgba(color, alpha))
+
+    # A line through the points - segment i (from point i to point i+1) is
+    #  drawn with widths[i] and colors[i] (or a single width and color).
+    #  Segments that cross the 180th meridian are left out.
+    def add_trail(self, lon, lat, widths, colors, alpha=1):
+        lon = np.asarray(lon)
+        lat = np.asarray(lat)
+        if len(lon) < 2:
+            return
+        segments = np.stack(
+            (np.stack((lon[:-1], lat[:-1]), -1), np.stack((lon[1:], lat[1:]), -1)),
+            axis=1,
+        )
+        widths = np.broadcast_to(widths, lon.shape)[:-1]
+        rgba = matplotlib.colors.to_rgba_array(colors)
+        rgba = np.broadcast_to(rgba, (len(lon), 4))[:-1].copy()
+        rgba[:, 3] = alpha
+        keep = np.abs(lon[:-1] - lon[1:]) <= 90
+        self.segments.append(segments[keep])
+        self.widths.append(widths[keep])
+        self.line_colors.append(rgba[keep])
+
+    # Add the collections to the axes. Returns the artists added.
+    def draw(self, ax, marker_zorder=180, line_zorder=150):
+        artists = []
+        if len(self.segments) > 0:
+            artists.append(
+                ax.add_collection(
+                    LineCollection(
+                        np.concatenate(self.segments),
+                        linewidths=np.concatenate(self.widths),
+                        colors=np.concatenate(self.line_colors),
+                        capstyle="projecting",  # Same as Line2D
+                        zorder=line_zorder,
+                    ),
+                    autolim=False,
+                )
+            )
+        if len(self.centres) > 0:
+            diameters = np.asarray(self.radii) * 2
+            artists.append(
+                ax.add_collection(
+                    EllipseCollection(
+                        diameters,
+                        diameters,
+                        0,
+                        units="xy",
+                        offsets=self.centres,
+                        offset_transform=ax.transData,
+                        facecolors=self.marker_colors,
+                        linewidths=0.0,
+                        zorder=marker_zorder,
+                    ),
+                    autolim=False,
+                )
+            )
+        return artists
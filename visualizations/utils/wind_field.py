@@ -0,0 +1,264 @@
+# Make the wind noise - a random field smeared out along the wind
+
+# Each point of the random field is treated as a particle: it is moved
+#  along with the wind, a step at a time, and at each step its value
+#  (scaled by the wind speed at its starting point) is added to the result
+#  at the point it has reached. So the random speckles become streaks
+#  along the wind direction.
+
+# All the particles are moved together, using work arrays allocated once.
+#  The values are added, in place, with np.add.at, so particles that reach
+#  the same point all count (a fancy-index add, result[i, j] += update,
+#  keeps only one of them), and the order of the additions is fixed, so
+#  the result is always the same.
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+# Which iterations each particle contributes to: particle p is active
+#  from iteration startpoints[p] to endpoints[p] - or, if the start is
+#  after the end, at all iterations except those in between.
+#  If sequence is not given, all particles are active all the time.
+def particle_schedule(npoints, sequence, iterations):
+    if sequence is None:
+        return (np.full(npoints, -1), np.full(npoints, iterations + 1))
+    startsi = np.arange(0, iterations, 3)
+    endpoints = np.tile(startsi, 1 + npoints // len(startsi))
+    endpoints += sequence % iterations
+    endpoints[endpoints >= iterations] -= iterations
+    startpoints = endpoints - 25
+    startpoints[startpoints < 0] += iterations
+    return (startpoints[0:npoints], endpoints[0:npoints])
+
+
+# z is the random field (the source of the distortions), already on the wind grid.
+#  If sequence is given, each particle only contributes for part of the
+#  iterations, with the part moving on as sequence increases - so
+#  successive frames show the streaks moving.
+def wind_field(uw, vw, z, sequence=None, iterations=50, epsilon=0.003, sscale=1):
+    (width, height) = z.data.shape
+    npoints = width * height
+    # Each point in this field has an index location (i,j)
+    #  and a real (x,y) position
+    xmin = np.min(uw.coords()[0].points)
+    xmax = np.max(uw.coords()[0].points)
+    ymin = np.min(uw.coords()[1].points)
+    ymax = np.max(uw.coords()[1].points)
+
+    i, j = np.mgrid[0:width, 0:height]
+    x = (xmin + (i / width) * (xmax - xmin)).astype(z.dtype).ravel()
+    y = (ymin + (j / height) * (ymax - ymin)).astype(z.dtype).ravel()
+    # Index of each particle's location in the flattened field
+    location = np.arange(npoints)
+
+    # Particle steps are calculated in double precision (as numpy.ma does
+    #  for a masked wind field)
+    u_flat = np.ma.getdata(uw.data).astype(np.float64).ravel()
+    v_flat = np.ma.getdata(vw.data).astype(np.float64).ravel()
+    # Value each particle adds at each step
+    speed = np.sqrt(uw.data**2 + vw.data**2)
+    update = (np.ma.getdata(z.data * speed) / sscale).ravel()
+
+    # Which iterations each particle contributes to
+    startpoints, endpoints = particle_schedule(npoints, sequence, iterations)
+    forward = endpoints > startpoints  # Contributes from start to end
+    wrapped = startpoints > endpoints  # Contributes outside end to start
+
+    # Work arrays
+    velocity = np.empty(npoints, dtype=u_flat.dtype)
+    scaled = np.empty(npoints, dtype=np.float64)
+    column = np.empty(npoints, dtype=location.dtype)
+    flag = np.empty(npoints, dtype=bool)
+    before = np.empty(npoints, dtype=bool)
+    after = np.empty(npoints, dtype=bool)
+    skip = np.empty(npoints, dtype=bool)
+    weights = np.empty(npoints, dtype=np.float64)
+    shifted = np.empty(npoints, dtype=y.dtype)
+    total = np.zeros(npoints, dtype=np.float64)
+
+    # Position to index: floor((p-pmin)/(pmax-pmin)*(n-1)), limited to 0..n-1
+    def to_index(p, pmin, pmax, n, out):
+        np.subtract(p, pmin, out=scaled)
+        np.divide(scaled, pmax - pmin, out=scaled)
+        np.multiply(scaled, n - 1, out=scaled)
+        np.floor(scaled, out=scaled)
+        np.clip(scaled, 0, n - 1, out=scaled)
+        out[:] = scaled
+
+    # Repeatedly, move the x,y points according to the vector field
+    #  and add the random field at their starting points to the result
+    #  at their new locations
+    for k in range(iterations):
+        np.take(v_flat, location, out=velocity)
+        velocity *= epsilon
+        x += velocity
+        np.clip(x, xmin, xmax, out=x)
+        np.take(u_flat, location, out=velocity)
+        velocity *= epsilon
+        y += velocity
+        # Wrap round in y
+        np.greater(y, ymax, out=flag)
+        np.subtract(y, ymax, out=shifted)
+        shifted += ymin
+        np.copyto(y, shifted, where=flag)
+        np.less(y, ymin, out=flag)
+        np.subtract(y, ymin, out=shifted)
+        shifted += ymax
+        np.copyto(y, shifted, where=flag)
+
+        to_index(x, xmin, xmax, width, location)
+        location *= height
+        to_index(y, ymin, ymax, height, column)
+        location += column
+
+        # Zero the contributions from particles not active at this iteration
+        np.less(k, startpoints, out=before)
+        np.greater(k, endpoints, out=after)
+        np.logical_or(before, after, out=skip)
+        skip &= forward
+        np.logical_and(before, after, out=flag)
+        flag &= wrapped
+        skip |= flag
+        np.copyto(weights, update)
+        np.copyto(weights, 0, where=skip)
+        np.add.at(total, location, weights)
+
+    # Result is a distorted version of the random field
+    result = z.copy()
+    result.data += total.reshape(width, height).astype(result.dtype)
+    return result
+
+
+# Alternative engine, line-integral-convolution style: instead of pushing
+#  each particle forward and scattering its value, trace each point of the
+#  result backwards along the wind and gather the values of the random field
+#  from the points upstream of it (bilinearly interpolated). Every point of
+#  the result gets the same number of samples, so the coverage is even, and
+#  the points are independent - so the field is done in chunks, which can
+#  be run in parallel on a thread pool (numpy releases the GIL for the
+#  array operations).
+# Arguments as for wind_field, so the two engines are interchangeable:
+#  the trace covers 'iterations' steps of 'epsilon'*wind, and with a sequence
+#  the sample from k+1 steps upstream is only included if the particle
+#  that started there would be active at iteration k. The interpolation
+#  makes the streaks smooth even if the trace takes longer steps, so it
+#  can take 'stride' iterations' worth at once (and do proportionally
+#  less work). 'threads' defaults to all the CPUs this process can use.
+def lic_field(
+    uw,
+    vw,
+    z,
+    sequence=None,
+    iterations=50,
+    epsilon=0.003,
+    sscale=1,
+    stride=2,
+    threads=None,
+    chunk_size=16384,
+):
+    (width, height) = z.data.shape
+    npoints = width * height
+    if width < 2 or height < 2:
+        raise Exception("Wind field grid must be at least 2x2")
+    xmin = np.min(uw.coords()[0].points)
+    xmax = np.max(uw.coords()[0].points)
+    ymin = np.min(uw.coords()[1].points)
+    ymax = np.max(uw.coords()[1].points)
+
+    # Work in grid-index units: point (i,j) is at position (i,j), x is
+    #  limited to 0..width-1 and y wraps round with period height-1.
+    #  Table of the values to interpolate at each point: the step in x and
+    #  y (in index units), and the value the particle starting there adds.
+    u = np.ma.getdata(uw.data).astype(np.float64)
+    v = np.ma.getdata(vw.data).astype(np.float64)
+    table = np.empty((3, width, height))
+    table[0] = v * (stride * epsilon * (width - 1) / (xmax - xmin))
+    table[1] = u * (stride * epsilon * (height - 1) / (ymax - ymin))
+    table[2] = np.ma.getdata(z.data) * np.sqrt(u**2 + v**2) * stride / sscale
+    # For each grid cell (i,j), the table values at its four corners: (i,j),
+    #  (i,j+1), (i+1,j), and (i+1,j+1) - so the interpolation needs only one
+    #  lookup. There's an extra row of cells at the top, for points on the
+    #  top edge.
+    corners = np.empty((3, width, height - 1, 4))
+    corners[:, :, :, 0] = table[:, :, :-1]
+    corners[:, :, :, 1] = table[:, :, 1:]
+    corners[:, :-1, :, 2] = table[:, 1:, :-1]
+    corners[:, :-1, :, 3] = table[:, 1:, 1:]
+    corners[:, -1, :, 2:] = corners[:, -1, :, :2]
+    corners = corners.reshape(3, -1, 4)
+    table = table.reshape(3, npoints)
+    period = height - 1
+
+    # Which iterations each particle is active at, as bits
+    #  (bit k%8 of byte k//8 is iteration k)
+    if sequence is not None:
+        startpoints, endpoints = particle_schedule(npoints, sequence, iterations)
+        forward = endpoints > startpoints
+        wrapped = startpoints > endpoints
+        active = np.zeros((npoints, (iterations + 7) // 8), dtype=np.uint8)
+        for k in range(iterations):
+            before = k < startpoints
+            after = k > endpoints
+            skip = forward & (before | after)
+            skip |= wrapped & before & after
+            active[:, k // 8] |= (~skip).astype(np.uint8) << (k % 8)
+
+    total = np.zeros(npoints)
+
+    # Trace back from the points start to stop-1 (in the flattened field)
+    def trace(start, stop):
+        location = np.arange(start, stop)
+        px = (location // height).astype(np.float64)
+        py = (location % height).astype(np.float64)
+        step_x, step_y = table[0:2, location]
+        weights = np.empty((stop - start, 4))
+        result = total[start:stop]
+        for k in range(stride - 1, iterations, stride):
+            px -= step_x
+            np.clip(px, 0, width - 1, out=px)
+            py -= step_y
+            np.add(py, period, out=py, where=py < 0)
+            np.subtract(py, period, out=py, where=py >= period)
+            # Bilinear interpolation weights for the corners of the cell
+            i0 = px.astype(np.intp)
+            j0 = py.astype(np.intp)
+            fx = px - i0
+            fy = py - j0
+            np.multiply(fx, fy, out=weights[:, 3])
+            np.subtract(fx, weights[:, 3], out=weights[:, 2])
+            np.subtract(fy, weights[:, 3], out=weights[:, 1])
+            np.subtract(1 - fx, weights[:, 1], out=weights[:, 0])
+            cell = i0 * period
+            cell += j0
+            step_x, step_y, value = (
+                np.einsum("nk,nk->n", np.take(corners[c], cell, axis=0), weights)
+                for c in range(3)
+            )
+            if sequence is None:
+                result += value
+                continue
+            # Only count the sample if the nearest particle is active
+            source = (i0 + (fx > 0.5)) * height
+            source += j0 + (fy > 0.5)
+            bits = active[source, k // 8] >> (k % 8)
+            bits &= 1
+            result += value * bits
+
+    chunks = [
+        (start, min(start + chunk_size, npoints))
+        for start in range(0, npoints, chunk_size)
+    ]
+    if threads is None:
+        threads = len(os.sched_getaffinity(0))
+    if threads > 1 and len(chunks) > 1:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(lambda chunk: trace(*chunk), chunks))
+    else:
+        for chunk in chunks:
+            trace(*chunk)
+
+    result = z.copy()
+    result.data += total.reshape(width, height).astype(result.dtype)
+    return result
@@ -0,0 +1,205 @@
+# Wind noise from a persistent population of particles
+
+# The other noise engines (wind_field.py) make each frame's noise from
+#  scratch: every particle starts from its home grid point and is moved 50
+#  steps along the wind. Here the particles are kept from frame to frame,
+#  and each new frame only moves them on by one frame's worth of steps -
+#  so a run of frames costs a few steps per frame, rather than 50, and
+#  the streaks move smoothly from one frame to the next.
+
+# Each grid point of the noise field is the home of one particle. A
+#  particle carries the value of the noise at its home (scaled by the wind
+#  speed there), and at each step it adds that value to a trail field, at
+#  the point it has reached. The trail field fades a little at each step,
+#  so each particle leaves a streak behind it. When a particle is
+#  'lifetime' steps old, it goes back to its home and starts again (the
+#  starting ages are staggered, so only a few particles restart at once).
+
+# The state (particle positions, ages, and values, and the trail field)
+#  can be saved to a checkpoint file, so a run of frames can carry on from
+#  where the previous run stopped. A checkpoint is only any use with the
+#  same noise field on the same grid (projection and extent), so those go
+#  into its key, and a checkpoint with a different key is not loaded.
+
+import os
+import datetime
+import hashlib
+import numpy as np
+
+
+class WindParticles:
+    # z is the random field (on the wind grid). Positions are kept in
+    #  grid-index units (float32), the ages as bytes.
+    def __init__(
+        self,
+        z,
+        steps_per_hour=5,
+        lifetime=50,
+        trail=25,
+        epsilon=0.003,
+        sscale=1,
+    ):
+        if lifetime > 255:
+            raise Exception("Particle lifetime must be less than 256 steps")
+        self.z = z
+        self.width, self.height = z.data.shape
+        self.npoints = self.width * self.height
+        self.steps_per_hour = steps_per_hour
+        self.lifetime = lifetime
+        self.fade = np.float32(np.exp(-1 / trail))
+        self.epsilon = epsilon
+        self.sscale = sscale
+        home = np.arange(self.npoints)
+        self.home_x = (home // self.height).astype(np.float32) + 0.5
+        self.home_y = (home % self.height).astype(np.float32) + 0.5
+        self.x = None
+        self.y = None
+        self.age = None
+        self.value = None
+        self.trails = None
+        self.time = None  # Time of the current state
+        self.key = self._key()
+
+    # Identity of the noise field and its grid - a hash of the field values,
+    #  the grid coordinates, and the coordinate system (projection)
+    def _key(self):
+        key = hashlib.sha1()
+        key.update(np.ascontiguousarray(np.ma.getdata(self.z.data)).tobytes())
+        for coord in self.z.coords():
+            key.update(coord.name().encode())
+            key.update(np.ascontiguousarray(coord.points, dtype=np.float64).tobytes())
+            key.update(repr(coord.coord_system).encode())
+        return key.hexdigest()
+
+    # Wind steps (in index units) and the values the particles take
+    #  when they leave home
+    def _wind(self, uw, vw):
+        xmin = np.min(uw.coords()[0].points)
+        xmax = np.max(uw.coords()[0].points)
+        ymin = np.min(uw.coords()[1].points)
+        ymax = np.max(uw.coords()[1].points)
+        u = np.ma.getdata(uw.data).astype(np.float32).ravel()
+        v = np.ma.getdata(vw.data).astype(np.float32).ravel()
+        step_x = v * np.float32(self.epsilon * (self.width - 1) / (xmax - xmin))
+        step_y = u * np.float32(self.epsilon * (self.height - 1) / (ymax - ymin))
+        start = np.ma.getdata(self.z.data).ravel() * np.sqrt(u**2 + v**2)
+        return (step_x, step_y, (start / self.sscale).astype(np.float32))
+
+    # Start again - all particles at home, with staggered ages - and run
+    #  for a whole lifetime, so the trails are all there
+    def spin_up(self, uw, vw, dte):
+        self.x = self.home_x.copy()
+        self.y = self.home_y.copy()
+        self.age = (np.arange(self.npoints) * 3 % self.lifetime).astype(np.uint8)
+        self.value = self._wind(uw, vw)[2]
+        self.trails = np.zeros(self.npoints, dtype=np.float32)
+        self.advance(uw, vw, self.lifetime)
+        self.time = dte
+
+    # Move the particles on 'steps' steps, with the wind (uw,vw)
+    def advance(self, uw, vw, steps):
+        step_x, step_y, start = self._wind(uw, vw)
+        location = np.empty(self.npoints, dtype=np.intp)
+        column = np.empty(self.npoints, dtype=np.intp)
+        for step in range(steps):
+            location[:] = self.x
+            np.minimum(location, self.width - 1, out=location)
+            location *= self.height
+            column[:] = self.y
+            location += column
+            self.x += step_x[location]
+            np.clip(self.x, 0, self.width - 1, out=self.x)
+            self.y += step_y[location]
+            # Wrap round in y
+            np.add(self.y, self.height, out=self.y, where=self.y < 0)
+            np.subtract(self.y, self.height, out=self.y, where=self.y >= self.height)
+            # Add the particle values to the (faded) trails
+            location[:] = self.x
+            np.minimum(location, self.width - 1, out=location)
+            location *= self.height
+            column[:] = self.y
+            np.minimum(column, self.height - 1, out=column)
+            location += column
+            self.trails *= self.fade
+            self.trails += np.bincount(
+                location, weights=self.value, minlength=self.npoints
+            ).astype(np.float32)
+            # Old particles go back home
+            self.age += 1
+            expired = self.age >= self.lifetime
+            self.x[expired] = self.home_x[expired]
+            self.y[expired] = self.home_y[expired]
+            self.value[expired] = start[expired]
+            self.age[expired] = 0
+
+    # Move the particles on to time dte. If there's no current state, or
+    #  it's not shortly before dte, start again.
+    def move_to(self, uw, vw, dte):
+        if self.time is not None:
+            steps = round(
+                (dte - self.time).total_seconds() / 3600 * self.steps_per_hour
+            )
+            if 0 <= steps <= self.lifetime:
+                self.advance(uw, vw, steps)
+                self.time = dte
+                return
+        self.spin_up(uw, vw, dte)
+
+    # The noise field: the random field plus the trails
+    def field(self):
+        result = self.z.copy()
+        result.data += self.trails.reshape(self.width, self.height).astype(result.dtype)
+        return result
+
+    # Parameters that a checkpoint must match
+    def _settings(self):
+        return np.array(
+            [
+                self.width,
+                self.height,
+                self.steps_per_hour,
+                self.lifetime,
+                self.fade,
+                self.epsilon,
+                self.sscale,
+            ],
+            dtype=np.float64,
+        )
+
+    def save(self, fname):
+        if self.time is None:
+            raise Exception("No particle state to save")
+        dirname = os.path.dirname(fname)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        np.savez(
+            "%s.tmp.npz" % fname,
+            x=self.x,
+            y=self.y,
+            age=self.age,
+            value=self.value,
+            trails=self.trails,
+            settings=self._settings(),
+            key=np.array(self.key),
+            time=np.array(self.time.isoformat()),
+        )
+        os.replace("%s.tmp.npz" % fname, fname)
+
+    # Restore the state from a checkpoint file. Returns False (and leaves
+    #  the state unchanged) if there's no such file, or it was made with
+    #  different settings, or for a different noise field or grid.
+    def load(self, fname):
+        if not os.path.isfile(fname):
+            return False
+        with np.load(fname) as f:
+            if not np.array_equal(f["settings"], self._settings()):
+                return False
+            if "key" not in f.files or str(f["key"]) != self.key:
+                return False
+            self.x = f["x"]
+            self.y = f["y"]
+            self.age = f["age"]
+            self.value = f["value"]
+            self.trails = f["trails"]
+            self.time = datetime.datetime.fromisoformat(str(f["time"]))
+        return True